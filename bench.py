@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# bench - measure how the dashboard pipeline scales
+#
+# This generates a synthetic (but zuul-shaped) status document and set of
+# gerrit changes from a seed, and then times each stage of what dash.py does
+# with them: decompressing and parsing the status, matching our changes,
+# working out job status and rendering. Results can be saved as a baseline
+# and later runs compared against it to catch regressions.
+
+import argparse
+import gc
+import gzip
+import io
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+import dash
+
+RESULTS = ['SUCCESS', 'SUCCESS', 'SUCCESS', 'FAILURE', 'SKIPPED', None, None]
+PIPELINES = ['check', 'gate', 'post', 'periodic', 'experimental']
+STAGES = ['decompress', 'parse', 'stream_parse', 'match', 'job_status',
+          'jenkins', 'render', 'diff_render']
+
+
+def make_job(rand, pipeline, now):
+    result = rand.choice(RESULTS)
+    return {'name': 'job-%i' % rand.randint(0, 500),
+            'pipeline': pipeline,
+            'result': result,
+            'voting': rand.random() > 0.1,
+            'start_time': now - rand.randint(0, 3600) if
+            result or rand.random() > 0.5 else None,
+            'elapsed_time': rand.randint(0, 3600000),
+            'uuid': '%032x' % rand.getrandbits(128)}
+
+
+def make_zuul_status(seed=0, pipelines=2, queue_depth=1000, jobs=30,
+                     change_base=100000):
+    """Make a zuul status document with pipelines * queue_depth items"""
+    rand = random.Random(seed)
+    now = int(time.time())
+    number = change_base
+    status = {'message': '',
+              'trigger_event_queue': {'length': rand.randint(0, 30)},
+              'pipelines': []}
+    for pipeline in (PIPELINES * pipelines)[:pipelines]:
+        heads = []
+        remaining = queue_depth
+        while remaining:
+            # Dependent pipelines have long heads, others mostly just one
+            length = min(remaining, rand.randint(1, 10) if
+                         pipeline == 'gate' else 1)
+            head = []
+            for _ in range(length):
+                number += rand.randint(1, 3)
+                head.append({
+                    'id': '%i,%i' % (number, rand.randint(1, 20)),
+                    'project': 'openstack/project-%i' % rand.randint(0, 50),
+                    'enqueue_time': (now - rand.randint(0, 7200)) * 1000,
+                    'live': True,
+                    'jobs': [make_job(rand, pipeline, now)
+                             for _ in range(jobs)]})
+            heads.append(head)
+            remaining -= length
+        status['pipelines'].append({
+            'name': pipeline,
+            'change_queues': [{'name': 'integrated', 'heads': heads}]})
+    return status
+
+
+def make_gerrit_changes(zuul_data, seed=0, watched=100, missing=0.2):
+    """Make watched gerrit changes, mostly ones that are in zuul_data
+
+    They have everything the detailed gerrit query returns. The lean one
+    returns less.
+    """
+    rand = random.Random(seed)
+    patchsets = dict((int(change['id'].split(',')[0]),
+                      int(change['id'].split(',')[1]))
+                     for pipeline in zuul_data['pipelines']
+                     for queue in pipeline['change_queues']
+                     for head in queue['heads']
+                     for change in head)
+    numbers = set(rand.sample(sorted(patchsets),
+                              min(len(patchsets),
+                                  int(watched * (1 - missing)))))
+    while len(numbers) < watched:
+        numbers.add(rand.randint(1, 99999))
+    owners = [{'_account_id': i, 'username': 'user%i' % i,
+               'name': 'User %i' % i} for i in range(max(1, watched // 10))]
+    changes = []
+    for number in sorted(numbers):
+        patchset = patchsets.get(number) or rand.randint(1, 20)
+        revision = '%040x' % rand.getrandbits(160)
+        changes.append({
+            '_number': number,
+            'number': number,
+            'subject': 'Change %i does something' % number,
+            'owner': rand.choice(owners),
+            'starred': rand.random() > 0.9,
+            'status': 'NEW',
+            'current_revision': revision,
+            'revisions': {revision: {'_number': patchset}},
+            'patchset': patchset,
+            'labels': {'Verified': {'all': [
+                {'_account_id': 0, 'username': 'zuul',
+                 'value': rand.choice([-1, 1])}]}},
+        })
+    return changes
+
+
+def measure(func, *args):
+    """Run func and return (result, seconds, peak bytes allocated)
+
+    The timing and the memory use come from separate runs, as tracing
+    allocations slows everything down a lot.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def run_stages(zuul_data, changes, user='user1'):
+    raw = json.dumps(zuul_data).encode()
+    compressed = gzip.compress(raw)
+    stats = {'_bytes': len(raw), '_compressed_bytes': len(compressed)}
+
+    def match():
+        dash.CACHE.pop('zuul_index', None)
+        return dash.match_changes_in_zuul(zuul_data, changes, [])
+
+    def job_status():
+        return [dash.get_job_status(change)
+                for pipeline in zuul_data['pipelines']
+                for queue in pipeline['change_queues']
+                for head in queue['heads']
+                for change in head]
+
+    results = {}
+
+    def render():
+        return dash.render_dashboard(user, True, changes, zuul_data,
+                                     *results['match'])
+
+    def diff_render():
+        renderer = dash.DiffRenderer(io.StringIO())
+        lines = results['render']
+        renderer.render(lines)
+        renderer.render(lines)
+
+    stages = [('decompress', gzip.decompress, compressed),
+              ('parse', json.loads, raw)]
+    if dash._import_ijson() is not None:
+        watched = dash.get_change_ids(changes)
+        stages.append(('stream_parse',
+                       lambda: dash._stream_zuul_status(io.BytesIO(raw),
+                                                        watched)))
+    stages.extend([
+        ('match', match),
+        ('job_status', job_status),
+        ('jenkins', lambda: dash.get_jenkins_info(
+            [c for c in changes if c['number'] in results['match'][2]])),
+        ('render', render),
+        ('diff_render', diff_render),
+    ])
+    for stage in stages:
+        name, func, args = stage[0], stage[1], stage[2:]
+        results[name], elapsed, peak = measure(func, *args)
+        stats[name] = {'seconds': elapsed, 'peak_bytes': peak}
+    return stats
+
+
+def best_of(repeat, zuul_data, changes):
+    """Keep the fastest time and the largest peak of each stage"""
+    best = None
+    for _ in range(repeat):
+        stats = run_stages(zuul_data, changes)
+        if best is None:
+            best = stats
+            continue
+        for stage in STAGES:
+            if stage in stats:
+                best[stage]['seconds'] = min(best[stage]['seconds'],
+                                             stats[stage]['seconds'])
+                best[stage]['peak_bytes'] = max(best[stage]['peak_bytes'],
+                                                stats[stage]['peak_bytes'])
+    return best
+
+
+def report(stats, baseline=None, tolerance=0.25):
+    """Print stats, returning the stages that regressed against baseline"""
+    regressions = []
+    print('Status: %.1f MB (%.1f MB compressed)' % (
+        stats['_bytes'] / 1048576.0, stats['_compressed_bytes'] / 1048576.0))
+    print('%-14s %10s %10s %s' % ('stage', 'ms', 'peak MB', ''))
+    for stage in STAGES:
+        if stage not in stats:
+            continue
+        seconds = stats[stage]['seconds']
+        note = ''
+        if baseline and stage in baseline:
+            ratio = seconds / max(baseline[stage]['seconds'], 1e-9)
+            note = '%+.0f%%' % ((ratio - 1) * 100)
+            if ratio > 1 + tolerance:
+                note += ' REGRESSION'
+                regressions.append(stage)
+        print('%-14s %10.2f %10.2f %s' % (
+            stage, seconds * 1000, stats[stage]['peak_bytes'] / 1048576.0,
+            note))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the dash.py pipeline on synthetic data')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pipelines', type=int, default=2,
+                        help='Number of pipelines')
+    parser.add_argument('--queue-depth', type=int, default=1000,
+                        help='Items in each pipeline')
+    parser.add_argument('--jobs', type=int, default=30,
+                        help='Jobs per item')
+    parser.add_argument('--watched', type=int, default=100,
+                        help='Number of changes we are watching')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of each stage to take the best of')
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help='Write the results here')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='Compare against results saved earlier and '
+                             'exit non-zero if any stage got slower')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='How much slower than the baseline is still '
+                             'okay (default 0.25 for 25%%)')
+    args = parser.parse_args()
+
+    zuul_data = make_zuul_status(args.seed, args.pipelines, args.queue_depth,
+                                 args.jobs)
+    changes = make_gerrit_changes(zuul_data, args.seed, args.watched)
+    print('%i pipelines x %i items, %i jobs each, %i watched changes' % (
+        args.pipelines, args.queue_depth, args.jobs, args.watched))
+    stats = best_of(args.repeat, zuul_data, changes)
+    stats['_params'] = vars(args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('_params', {}).get('queue_depth') != args.queue_depth:
+            print('Warning: baseline was made with different parameters')
+    regressions = report(stats, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+    if regressions:
+        print('Slower than baseline: %s' % ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
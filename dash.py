@@ -16,35 +16,343 @@
 
 from __future__ import print_function
 
+# NOTE: This gets run constantly from shell prompts and status bars, so
+# anything that isn't needed on every run (requests, colorama, ssl, ...) is
+# imported through _import() when it is first used instead of here.
+# test_dash.py holds us to DASH_IMPORT_BUDGET.
+
 import argparse
-import colorama
-import gzip
+import bisect
+import contextlib
+import functools
+import hashlib
+import importlib
 import json
 import os
-import pprint
+import random
 import re
-import requests
-import requests.auth
-import ssl
+import shutil
+import socket
+import socketserver
 import sys
+import threading
 import time
 
-try:
-    import urllib2
-except ImportError:
-    # python3
-    from urllib import request as urllib2
-try:
-    from cStringIO import StringIO as BytesIO
-except ImportError:
-    # python3
-    from io import BytesIO
+from urllib import parse as urlparse
 
 
 IGNORE_QUEUES = ['merge-check', 'silent']
 CACHE = {}
+GERRIT_TIMEOUT = 30
+GERRIT_URL = os.environ.get('DASH_GERRIT_URL', 'https://review.opendev.org')
+# Gerrit caps how many results a query returns, so we page through them
+GERRIT_PAGE_SIZE = 250
+GERRIT_PAGE_PREFETCH = 2
+# Very long queries run into URL length limits, so split them up
+GERRIT_SHARD_SIZE = 50
+GERRIT_WORKERS = 8
+# The main query only returns what matching and rendering need (owners
+# are just account ids). Labels are big, so they are only fetched for the
+# few changes that -j shows because they are not in zuul.
+GERRIT_OPTIONS = ()
+LABEL_OPTIONS = ('CURRENT_REVISION', 'DETAILED_LABELS', 'DETAILED_ACCOUNTS')
+# Accounts whose Verified votes are the CI score
+CI_USERS = ('zuul', 'jenkins')
+# In refresh mode, how often to redo the full query rather than just asking
+# for what changed, and how much overlap to allow between polls.
+GERRIT_RESYNC = 600
+GERRIT_AGE_SLACK = 30
+# With --gerrit-cache-ttl, one-shot runs reuse the results of the same
+# query for that long. It is off by default, so nobody is shown old results
+# without asking for them. The on-disk cache is kept under this many
+# megabytes.
+GERRIT_CACHE_TTL = 0
+GERRIT_CACHE_SIZE = 50
+# How long a refreshing dash waits before asking gerrit again for an
+# account it failed to look up. Failures aren't kept between runs.
+ACCOUNT_RETRY = 300
+ZUUL_TIMEOUT = 60
+# Heads that don't contain a watched change are replaced by a placeholder
+# carrying only the number of queue positions they occupy.
+SKIP_KEY = '_skip'
+HEAD_PREFIX = 'pipelines.item.change_queues.item.heads.item'
+# Every strategy asks the same zuul, so they all share its connections
+ZUUL_URL = os.environ.get('DASH_ZUUL_URL', 'https://zuul.opendev.org')
+ZUUL_STATUS_URL = ZUUL_URL + '/api/status'
+ZUUL_TENANT = 'openstack'
+# Up to this many changes we ask zuul about each one rather than pulling
+# the status of the whole tenant.
+ZUUL_PER_CHANGE_LIMIT = 5
+ZUUL_STRATEGIES = ('auto', 'change', 'tenant', 'global')
+# Keep-alive connections kept open to each zuul host. This should be at
+# least ZUUL_PER_CHANGE_LIMIT so per-change fetches don't open new ones.
+ZUUL_POOL_SIZE = 8
+# --record starts a new segment, with full snapshots rather than deltas,
+# after this many refreshes.
+RECORD_SEGMENT_SIZE = 360
+CACHE_DIR = os.environ.get(
+    'DASH_CACHE_DIR',
+    os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                os.path.expanduser('~/.cache')),
+                 'dash'))
+
+session = None
+zuul_session = None
+_session_lock = threading.Lock()
+_import_lock = threading.RLock()
+
+
+@functools.lru_cache(maxsize=None)
+def _import(name):
+    # Only one thread imports at a time, as a module being imported by one
+    # thread is only partly there for the others.
+    with _import_lock:
+        return importlib.import_module(name)
+
+
+@functools.lru_cache(maxsize=None)
+def _import_ijson():
+    # ijson is optional, so see if it's there the first time we need it
+    try:
+        return _import('ijson')
+    except ImportError:
+        return None
+
+
+def get_session():
+    global session
+    with _session_lock:
+        if session is None:
+            session = _import('requests').Session()
+        return session
+
+
+def make_zuul_session(pool_size=ZUUL_POOL_SIZE):
+    """A session for every zuul endpoint we talk to
+
+    Connections are kept alive between refreshes, so only the first fetch
+    from each host pays for the TCP and TLS handshakes.
+    """
+    requests = _import('requests')
+    urllib3 = _import('urllib3')
+    zuul = requests.Session()
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    adapter = _import('requests.adapters').HTTPAdapter(pool_maxsize=pool_size)
+    # All the pooled connections share one SSL context
+    adapter.poolmanager.connection_pool_kw['ssl_context'] = (
+        _import('ssl')._create_unverified_context())
+    zuul.mount('https://', adapter)
+    zuul.mount('http://', adapter)
+    return zuul
+
+
+def get_zuul_session():
+    global zuul_session
+    with _session_lock:
+        if zuul_session is None:
+            zuul_session = make_zuul_session()
+        return zuul_session
+
+
+def zuul_connection_stats():
+    """Return (requests, connections) made over zuul_session so far"""
+    nrequests = nconnections = 0
+    if zuul_session is None:
+        return nrequests, nconnections
+    adapter = zuul_session.get_adapter('https://')
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+            nrequests += pool.num_requests
+            nconnections += pool.num_connections
+    return nrequests, nconnections
+
+# How long each stage of the last refresh took and how many bytes it
+# handled, for --timings, --metrics-file and the dump options.
+TIMINGS = {}
+TIMING_STAGES = ('gerrit_cache', 'gerrit', 'zuul', 'gunzip', 'parse',
+                 'gerrit_wait', 'match', 'render', 'output')
+_timings_lock = threading.Lock()
+PROFILER = None
+
+
+def record_timing(stage, seconds, nbytes=0):
+    # Several threads (gerrit pages, per-change zuul fetches) add to the
+    # same stage, so it's the work done rather than the wall clock time.
+    with _timings_lock:
+        entry = TIMINGS.setdefault(stage, {'seconds': 0.0, 'bytes': 0})
+        entry['seconds'] += seconds
+        entry['bytes'] += nbytes
+
+
+@contextlib.contextmanager
+def timed(stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_timing(stage, time.time() - start)
+
+
+def reset_timings():
+    """Start timing a new refresh
+
+    Writing to the terminal is the last thing a refresh does, after its
+    footer was rendered, so the output time of the previous one is kept.
+    """
+    with _timings_lock:
+        output = TIMINGS.get('output')
+        TIMINGS.clear()
+        if output is not None:
+            TIMINGS['output'] = output
+
+
+def _stage_seconds(stage):
+    with _timings_lock:
+        return TIMINGS.get(stage, {}).get('seconds', 0.0)
+
+
+class _TimedReader(object):
+    """Count the time spent in, and bytes returned by, read() on a stream"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def read(self, size=-1):
+        start = time.time()
+        chunk = self._stream.read(size)
+        self.seconds += time.time() - start
+        self.bytes += len(chunk)
+        return chunk
+
+
+def format_bytes(nbytes):
+    if nbytes < 1024:
+        return '%iB' % nbytes
+    for unit in ('KB', 'MB', 'GB'):
+        nbytes /= 1024.0
+        if nbytes < 1024 or unit == 'GB':
+            return '%.1f%s' % (nbytes, unit)
 
-session = requests.Session()
+
+def format_timings():
+    parts = []
+    for stage in TIMING_STAGES:
+        if stage not in TIMINGS:
+            continue
+        entry = TIMINGS[stage]
+        if entry['seconds'] < 1:
+            part = '%s %.0fms' % (stage, entry['seconds'] * 1000)
+        else:
+            part = '%s %.2fs' % (stage, entry['seconds'])
+        if entry['bytes']:
+            part += ' (%s)' % format_bytes(entry['bytes'])
+        parts.append(part)
+    return ', '.join(parts)
+
+
+def timing_lines():
+    if not TIMINGS:
+        return []
+    lines = ['Timings: %s' % format_timings()]
+    nrequests, nconnections = zuul_connection_stats()
+    if nrequests:
+        lines.append('Zuul connections: %i opened for %i requests' % (
+            nconnections, nrequests))
+    return lines
+
+
+def write_metrics(path):
+    """Write the last refresh's timings in prometheus' text format"""
+    with _timings_lock:
+        timings = sorted(TIMINGS.items())
+    lines = ['# HELP dash_stage_seconds Time spent in each stage of the last '
+             'refresh',
+             '# TYPE dash_stage_seconds gauge']
+    lines.extend('dash_stage_seconds{stage="%s"} %f' % (stage, e['seconds'])
+                 for stage, e in timings)
+    lines.extend(['# HELP dash_stage_bytes Bytes handled by each stage of '
+                  'the last refresh',
+                  '# TYPE dash_stage_bytes gauge'])
+    lines.extend('dash_stage_bytes{stage="%s"} %i' % (stage, e['bytes'])
+                 for stage, e in timings if e['bytes'])
+    nrequests, nconnections = zuul_connection_stats()
+    lines.extend(['# HELP dash_zuul_requests_total Requests made to zuul',
+                  '# TYPE dash_zuul_requests_total counter',
+                  'dash_zuul_requests_total %i' % nrequests,
+                  '# HELP dash_zuul_connections_total Connections opened '
+                  'to zuul',
+                  '# TYPE dash_zuul_connections_total counter',
+                  'dash_zuul_connections_total %i' % nconnections])
+    lines.extend(['# HELP dash_last_refresh_timestamp_seconds When the last '
+                  'refresh finished',
+                  '# TYPE dash_last_refresh_timestamp_seconds gauge',
+                  'dash_last_refresh_timestamp_seconds %f' % time.time()])
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(tmp, path)
+
+
+class CycleProfiler(object):
+    """Collect cProfile stats over the first few refreshes
+
+    cProfile only sees the thread it is enabled in, so work handed to the
+    thread pools goes through _submit() to be profiled as well.
+    """
+
+    def __init__(self, cycles, output=None, stream=None):
+        self.cycles = cycles
+        self.output = output
+        self.stream = stream
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def wrap(self, func):
+        def wrapper(*args, **kwargs):
+            profile = _import('cProfile').Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Newer pythons only allow one profiler at a time
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self._lock:
+                    self.profiles.append(profile)
+        return wrapper
+
+    def run(self, func, *args, **kwargs):
+        if self.cycles <= 0:
+            return func(*args, **kwargs)
+        try:
+            return self.wrap(func)(*args, **kwargs)
+        finally:
+            self.cycles -= 1
+            if not self.cycles:
+                self.report()
+
+    def report(self):
+        with self._lock:
+            profiles, self.profiles = self.profiles, []
+        if not profiles:
+            return
+        stats = _import('pstats').Stats(*profiles,
+                                        stream=self.stream or sys.stderr)
+        if self.output:
+            stats.dump_stats(self.output)
+        stats.sort_stats('cumulative').print_stats(30)
+
+
+def _submit(pool, func, *args, **kwargs):
+    if PROFILER is not None and PROFILER.cycles > 0:
+        func = PROFILER.wrap(func)
+    return pool.submit(func, *args, **kwargs)
 
 
 def make_filter(key, value, operator):
@@ -55,7 +363,7 @@ def make_filter(key, value, operator):
         return '%s:%s' % (key, value)
 
 
-def get_pending_changes(auth_creds, filters, operator, projects, gerrit_query):
+def build_query(filters, operator, projects, gerrit_query, status='open'):
     query_parts = []
     if filters:
         query_items = [make_filter(x, y, operator) for x, y in filters.items()]
@@ -71,60 +379,712 @@ def get_pending_changes(auth_creds, filters, operator, projects, gerrit_query):
         query_parts.append(gerrit_query)
 
     query = '(%s)' % (' %s ' % operator).join(query_parts)
-    if query.strip():
-        query += ' AND '
-    query += 'status:open'
-
-    auth = requests.auth.HTTPBasicAuth(*auth_creds)
-    result = session.get('https://review.opendev.org/a/changes/',
-                         params={'q': query,
-                                 'o': 'DETAILED_ACCOUNTS',
-                                 'pp': '0'},
-                         auth=auth,
-                         timeout=30)
+    if status:
+        if query.strip():
+            query += ' AND '
+        query += 'status:%s' % status
+    return query
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def build_queries(filters, operator, projects, gerrit_query, status='open',
+                  shard_size=GERRIT_SHARD_SIZE):
+    """Split a query into sub-queries of at most shard_size terms each
+
+    The union of the sub-query results is the same as the result of the
+    full query from build_query(). With OR every term stands on its own, so
+    they can be spread freely across the shards. With AND only the project
+    list (which is always OR'd) can be split up.
+    """
+    if operator == 'OR':
+        terms = []
+        for key, value in filters.items():
+            values = value if isinstance(value, list) else [value]
+            terms.extend(make_filter(key, v, operator) for v in values)
+        terms.extend('project:%s' % p for p in projects)
+        if gerrit_query:
+            terms.append('(%s)' % gerrit_query)
+        if len(terms) <= shard_size:
+            return [build_query(filters, operator, projects, gerrit_query,
+                                status)]
+        return [build_query({}, operator, [], '(%s)' % ' OR '.join(chunk),
+                            status)
+                for chunk in _chunks(terms, shard_size)]
+
+    if len(projects) <= shard_size:
+        return [build_query(filters, operator, projects, gerrit_query,
+                            status)]
+    return [build_query(filters, operator, chunk, gerrit_query, status)
+            for chunk in _chunks(projects, shard_size)]
+
+
+def _query_gerrit(auth, query, start, limit, options=GERRIT_OPTIONS):
+    result = get_session().get(GERRIT_URL + '/a/changes/',
+                               params={'q': query,
+                                       'o': list(options),
+                                       'pp': '0',
+                                       'S': start,
+                                       'n': limit},
+                               auth=auth,
+                               timeout=GERRIT_TIMEOUT)
     result.raise_for_status()
 
     data = result.content
-    result = data[5:]
-    changes = json.loads(result)
+    record_timing('gerrit', 0, len(data))
+    return json.loads(data[5:])
+
+
+def _account_path(user):
+    key = hashlib.sha1(json.dumps([GERRIT_URL, user]).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, 'gerrit', '%s.account' % key)
+
+
+def get_account_id(auth_creds, user):
+    """Look up the account id of a gerrit username, or None
+
+    The lean gerrit query only tells us the account ids of owners, so
+    this is what we compare them to. Ids never change, so they are kept
+    next to the gerrit cache and each user is only looked up once. A failed
+    lookup is retried after ACCOUNT_RETRY seconds, or by the next run, and
+    account_lines() says what went wrong.
+    """
+    accounts = CACHE.setdefault('accounts', {})
+    if not user or user in accounts:
+        return accounts.get(user)
+    failed = CACHE.setdefault('account_errors', {}).get(user)
+    if failed and time.time() - failed[1] < ACCOUNT_RETRY:
+        return None
+    path = _account_path(user)
+    try:
+        with open(path) as f:
+            account_id = json.load(f)['id']
+        if account_id is not None:
+            return _remember_account(user, account_id)
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    try:
+        result = get_session().get(
+            GERRIT_URL + '/a/accounts/%s' % urlparse.quote(user, safe=''),
+            auth=_import('requests.auth').HTTPBasicAuth(*auth_creds),
+            timeout=GERRIT_TIMEOUT)
+        result.raise_for_status()
+        account_id = json.loads(result.content[5:])['_account_id']
+    except Exception as e:
+        # Not being able to highlight our own changes is no reason to fail
+        CACHE['account_errors'][user] = (str(e), time.time())
+        return None
+    tmp = '%s.%i.%i.tmp' % (path, os.getpid(), threading.get_ident())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp, 'w') as f:
+            json.dump({'id': account_id}, f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass
+    return _remember_account(user, account_id)
+
+
+def _remember_account(user, account_id):
+    CACHE['accounts'][user] = account_id
+    CACHE['account_errors'].pop(user, None)
+    return account_id
+
+
+def account_lines(user):
+    """A footer line if user's account could not be looked up"""
+    failed = CACHE.get('account_errors', {}).get(user)
+    if failed is None:
+        return []
+    return [yellow_line('Failed to look up gerrit account %s: %s' % (
+        user, failed[0]))]
+
+
+def is_user(owner, user):
+    """Whether an owner record is user, by username or account id"""
+    if owner.get('username') is not None:
+        return owner.get('username') == user
+    account_id = CACHE.get('accounts', {}).get(user)
+    return account_id is not None and owner.get('account_id') == account_id
+
+
+def fetch_changes(auth, queries, page_size=GERRIT_PAGE_SIZE,
+                  options=GERRIT_OPTIONS):
+    """Run all the queries in parallel, following gerrit's pagination
+
+    When a page says there are _more_changes, the next GERRIT_PAGE_PREFETCH
+    pages are requested at once instead of one round trip at a time. Pages
+    past the end just come back empty. Results are deduped by change number.
+    """
+    futures = _import('concurrent.futures')
+    pool = futures.ThreadPoolExecutor(max_workers=GERRIT_WORKERS)
+    pending = {}
+    last_page = {}
+    changes = {}
+
+    def submit(query, page):
+        future = _submit(pool, _query_gerrit, auth, query, page * page_size,
+                         page_size, options)
+        pending[future] = (query, page)
+        last_page[query] = page
+
+    try:
+        for query in queries:
+            submit(query, 0)
+        while pending:
+            done, _ = futures.wait(pending,
+                                   return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                query, page = pending.pop(future)
+                page_changes = future.result()
+                for change in page_changes:
+                    changes.setdefault(change['_number'], change)
+                if page_changes and page_changes[-1].pop('_more_changes',
+                                                         False):
+                    for next_page in range(last_page[query] + 1,
+                                           page + GERRIT_PAGE_PREFETCH + 1):
+                        submit(query, next_page)
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+    return _sort_changes(changes.values())
+
+
+def _sort_changes(changes):
+    # Keep gerrit's most-recently-updated-first order
+    return sorted(changes,
+                  key=lambda c: (c.get('updated', ''), c['_number']),
+                  reverse=True)
+
+
+def get_pending_changes(auth_creds, filters, operator, projects, gerrit_query,
+                        status='open', age=None, options=GERRIT_OPTIONS):
+    queries = build_queries(filters, operator, projects, gerrit_query, status)
+    if age is not None:
+        # Only changes updated in the last age seconds
+        queries = ['%s AND -age:%is' % (q, age) for q in queries]
+    auth = _import('requests.auth').HTTPBasicAuth(*auth_creds)
+    with timed('gerrit'):
+        changes = fetch_changes(auth, queries, options=options)
     _changes = []
     for change in changes:
         if '_number' in change:
             change['number'] = change['_number']
+        if change.get('current_revision') in change.get('revisions', {}):
+            revision = change['revisions'][change['current_revision']]
+            change['patchset'] = revision['_number']
         _changes.append(change)
     return _changes
 
 
-def dump_gerrit(auth_creds, filters, operator, projects, query):
-    pprint.pprint(get_pending_changes(auth_creds, filters, operator, projects, query))
+def get_changes_incremental(auth_creds, filters, operator, projects,
+                            gerrit_query, resync=GERRIT_RESYNC,
+                            options=GERRIT_OPTIONS):
+    """Like get_pending_changes(), but only fetch what changed since last time
+
+    The changes from the last poll are kept in an index and only changes
+    updated since then are asked for. Changes that were merged or abandoned
+    in the meantime are dropped. Every resync seconds we do a full query
+    again to catch anything else that fell out of the query.
+    """
+    key = tuple(build_queries(filters, operator, projects, gerrit_query))
+    state = CACHE.setdefault('gerrit', {}).get(key)
+    start = time.time()
+    if state is None or start - state['full'] >= resync:
+        changes = get_pending_changes(auth_creds, filters, operator, projects,
+                                      gerrit_query, options=options)
+        CACHE['gerrit'][key] = {
+            'index': dict((c['_number'], c) for c in changes),
+            'polled': start,
+            'full': start,
+        }
+        return changes
+
+    age = int(start - state['polled']) + GERRIT_AGE_SLACK
+    updates = get_pending_changes(auth_creds, filters, operator, projects,
+                                  gerrit_query, status=None, age=age,
+                                  options=options)
+    index = state['index']
+    for change in updates:
+        if change.get('status', 'NEW') == 'NEW':
+            index[change['_number']] = change
+        else:
+            index.pop(change['_number'], None)
+    state['polled'] = start
+    return _sort_changes(index.values())
+
+
+class GerritCache(object):
+    """An on-disk cache of query results, shared between runs
+
+    Entries are keyed by the normalized queries get_pending_changes() would
+    run, and who runs them, as things like is:starred depend on the user.
+    They are fresh for ttl seconds. For swr seconds after that a stale
+    entry is still returned while it is refreshed in the background. Once
+    the cache grows past size bytes the least recently used entries are
+    removed.
+    """
+
+    def __init__(self, ttl, swr=0, size=GERRIT_CACHE_SIZE * 1024 * 1024):
+        self.ttl = ttl
+        self.swr = swr
+        self.size = size
+
+    @staticmethod
+    def key(user, queries, options):
+        queries = sorted(' '.join(q.split()) for q in queries)
+        data = json.dumps([GERRIT_URL, user, queries, sorted(options)])
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(CACHE_DIR, 'gerrit', '%s.json' % key)
+
+    def _load(self, key):
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+            # Touch it so that eviction goes by when it was last used
+            os.utime(self._path(key), None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    def _store(self, key, changes):
+        path = self._path(key)
+        tmp = '%s.%i.%i.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(tmp, 'w') as f:
+                json.dump({'fetched': time.time(), 'changes': changes}, f)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            return
+        self._evict()
+
+    def _evict(self):
+        cache_dir = os.path.join(CACHE_DIR, 'gerrit')
+        entries = []
+        for name in os.listdir(cache_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.size:
+                break
+            try:
+                os.unlink(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+
+    def _fetch(self, key, auth_creds, filters, operator, projects,
+               gerrit_query, options):
+        changes = get_pending_changes(auth_creds, filters, operator,
+                                      projects, gerrit_query,
+                                      options=options)
+        self._store(key, changes)
+        return changes
+
+    def get_pending_changes(self, auth_creds, filters, operator, projects,
+                            gerrit_query, options=GERRIT_OPTIONS):
+        queries = build_queries(filters, operator, projects, gerrit_query)
+        key = self.key(auth_creds[0], queries, options)
+        args = (key, auth_creds, filters, operator, projects, gerrit_query,
+                options)
+        with timed('gerrit_cache'):
+            entry = self._load(key)
+        if entry is None:
+            return self._fetch(*args)
+        age = time.time() - entry['fetched']
+        if age < self.ttl:
+            return entry['changes']
+        if age < self.ttl + self.swr:
+            # Not a daemon thread, so a one-shot run still gets to save
+            # the fresh results before it exits.
+            threading.Thread(target=self._revalidate, args=args).start()
+            return entry['changes']
+        return self._fetch(*args)
+
+    def _revalidate(self, *args):
+        try:
+            self._fetch(*args)
+        except Exception:
+            # We'll try again next time
+            pass
+
+
+def dump_gerrit(auth_creds, filters, operator, projects, query,
+                gerrit_cache=None):
+    reset_timings()
+    if gerrit_cache is not None:
+        changes = gerrit_cache.get_pending_changes(auth_creds, filters,
+                                                   operator, projects, query)
+    else:
+        changes = get_pending_changes(auth_creds, filters, operator,
+                                      projects, query)
+    _import('pprint').pprint(changes)
+    print('Gerrit: %s' % format_timings(), file=sys.stderr)
 
 
-def _get_zuul_status():
-    req = urllib2.Request('https://zuul.openstack.org/api/status')
-    req.add_header('Accept-encoding', 'gzip')
+def _snapshot_paths(url):
+    key = hashlib.sha1(url.encode()).hexdigest()[:12]
+    base = os.path.join(CACHE_DIR, 'zuul-status-%s' % key)
+    return base + '.json.gz', base + '.meta'
+
+
+def _load_snapshot_meta(url):
+    data_path, meta_path = _snapshot_paths(url)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if meta.get('url') != url or not os.path.exists(data_path):
+        return None
+    return meta
+
+
+def _save_snapshot_meta(url, meta):
+    data_path, meta_path = _snapshot_paths(url)
+    tmp = meta_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.rename(tmp, meta_path)
+
+
+class _SnapshotWriter(object):
+    """Tee a zuul response body into a compressed on-disk snapshot
+
+    The snapshot is always stored gzipped. If zuul already sent us gzip, the
+    raw body is written as-is so we don't pay for compressing it again.
+    """
+
+    def __init__(self, url, stream, compressed):
+        self._stream = stream
+        self._path = _snapshot_paths(url)[0]
+        self._tmp = '%s.%i.tmp' % (self._path, os.getpid())
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            self._file = open(self._tmp, 'wb')
+        except (IOError, OSError):
+            self._file = None
+            self._out = None
+            return
+        if compressed:
+            self._out = self._file
+        else:
+            self._out = _import('gzip').GzipFile(fileobj=self._file,
+                                                 mode='wb')
+
+    def read(self, size=-1):
+        chunk = self._stream.read(size)
+        if self._out is not None:
+            self._out.write(chunk)
+        return chunk
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+            os.unlink(self._tmp)
+            self._file = self._out = None
+
+    def commit(self):
+        """Store the snapshot once the whole body has been read"""
+        if self._out is None:
+            return False
+        while self.read(65536):
+            pass
+        if self._out is not self._file:
+            self._out.close()
+        self._file.close()
+        os.rename(self._tmp, self._path)
+        return True
+
+
+def _parse_zuul_status(stream, watched):
+    if watched is None:
+        return json.load(stream)
+    elif _import_ijson() is not None:
+        return _stream_zuul_status(stream, watched)
+    else:
+        return _filter_zuul_status(json.load(stream), watched)
+
+
+def _load_zuul_snapshot(url, watched):
+    """Parse the on-disk snapshot, reusing the last parse if we can"""
+    meta = _load_snapshot_meta(url)
+    watched_key = None if watched is None else frozenset(
+        _resolve_watched(watched))
+    memo = CACHE.get('zuul_snapshot')
+    if memo and memo[:3] == (url, meta.get('etag'), watched_key):
+        return memo[3]
+    gzip = _import('gzip')
+    with timed('parse'), gzip.open(_snapshot_paths(url)[0], 'rb') as stream:
+        zuul_data = _parse_zuul_status(stream, watched_key)
+    CACHE['zuul_snapshot'] = (url, meta.get('etag'), watched_key, zuul_data)
+    return zuul_data
+
+
+def _get_zuul_status(watched=None, cache_ttl=0, url=None, snapshot=True):
+    url = url or ZUUL_STATUS_URL
+    meta = _load_snapshot_meta(url) if snapshot else None
+    if meta and cache_ttl and time.time() - meta['fetched'] < cache_ttl:
+        # Recent enough that we don't even need to ask zuul
+        return _load_zuul_snapshot(url, watched)
+
+    headers = {'Accept-Encoding': 'gzip'}
+    if meta:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    start = time.time()
+    # We read the raw body ourselves so it is streamed and stays compressed
+    # for the snapshot.
     # NOTE(SamYaple): We don't really care about verifying the cert, and the
     # url tends to be in and out of having a valid cert, esspecially with
     # zuulv3 landing
-    ctx = ssl._create_unverified_context()
-    zuul = urllib2.urlopen(req, timeout=60, context=ctx)
-    data = b''
-    while True:
-        chunk = zuul.read()
-        if not chunk:
-            break
-        data += chunk
+    zuul = get_zuul_session().get(url, headers=headers, stream=True,
+                                  verify=False, timeout=ZUUL_TIMEOUT)
+    if zuul.status_code == 304 and meta:
+        # Not modified since our snapshot
+        zuul.raw.release_conn()
+        record_timing('zuul', time.time() - start)
+        meta['fetched'] = time.time()
+        _save_snapshot_meta(url, meta)
+        return _load_zuul_snapshot(url, watched)
+    try:
+        zuul.raise_for_status()
+    except _import('requests').HTTPError:
+        zuul.close()
+        raise
+
+    compressed = zuul.headers.get('Content-Encoding') == 'gzip'
+    # Downloading, decompressing and parsing are interleaved, so time the
+    # reads at each layer and work out how long each took on its own.
+    download = _TimedReader(zuul.raw)
+    writer = None
+    stream = download
+    if snapshot:
+        writer = stream = _SnapshotWriter(url, download, compressed)
+    if compressed:
+        # Decompress as we read rather than buffering the whole body
+        stream = _TimedReader(_import('gzip').GzipFile(fileobj=stream,
+                                                       mode='rb'))
+    connected = time.time()
+    waited = _stage_seconds('gerrit_wait')
+    try:
+        zuul_data = _parse_zuul_status(stream, watched)
+    except Exception:
+        if writer is not None:
+            writer.abort()
+        # Don't hand a half-read connection back to the pool
+        zuul.close()
+        raise
+    parsing = time.time() - connected
+    # Streaming may have had to wait for gerrit to know what to keep
+    parsing -= _stage_seconds('gerrit_wait') - waited
+    read = download.seconds
+    if compressed:
+        record_timing('gunzip', stream.seconds - read, stream.bytes)
+        read = stream.seconds
+    record_timing('parse', parsing - read, stream.bytes if compressed
+                  else download.bytes)
+
+    committed = writer is not None and writer.commit()
+    # Whatever is left (like the gzip trailer) has to be read before the
+    # connection can be used again.
+    zuul.raw.drain_conn()
+    zuul.raw.release_conn()
+    record_timing('zuul', connected - start + download.seconds,
+                  download.bytes)
+    if committed:
+        meta = {'url': url,
+                'etag': zuul.headers.get('ETag'),
+                'last_modified': zuul.headers.get('Last-Modified'),
+                'fetched': time.time()}
+        _save_snapshot_meta(url, meta)
+        watched_key = None if watched is None else frozenset(
+            _resolve_watched(watched))
+        CACHE['zuul_snapshot'] = (url, meta['etag'], watched_key, zuul_data)
+    return zuul_data
+
+
+def _head_length(head):
+    """The number of queue positions process_changes() counts for a head"""
+    if len(head) > 0 and not is_dependent_queue(head):
+        return 1
+    return len(head)
+
+
+def _add_head(queue, head, watched_ids):
+    if any(get_change_id(change) in watched_ids for change in head):
+        queue['heads'].append(head)
+        return
+    skip = _head_length(head)
+    if queue['heads'] and SKIP_KEY in queue['heads'][-1][0]:
+        queue['heads'][-1][0][SKIP_KEY] += skip
+    else:
+        queue['heads'].append([{SKIP_KEY: skip}])
+
+
+def _resolve_watched(watched):
+    # This may be a callable so that we can start downloading from zuul
+    # before gerrit has told us which changes we care about.
+    if callable(watched):
+        with timed('gerrit_wait'):
+            watched = watched()
+    return set(watched)
+
+
+def choose_zuul_strategy(filters, projects, query, strategy='auto'):
+    """Work out the cheapest way to get zuul data for what we're watching
+
+    'change' asks zuul about each watched change individually, 'tenant'
+    fetches the status of just our tenant and 'global' the whole status
+    document.
+    """
+    if strategy != 'auto':
+        return strategy
+    changes = filters.get('change') or []
+    if (changes and list(filters) == ['change'] and not projects and
+            not query and len(changes) <= ZUUL_PER_CHANGE_LIMIT):
+        return 'change'
+    return 'tenant'
+
+
+def _get_zuul_changes(watched, cache_ttl=0, tenant=ZUUL_TENANT):
+    """Build a status document from zuul's per-change status endpoint
+
+    The result only has the watched changes in it, so the queue positions
+    and lengths are unknown. That is flagged with _partial. There is an
+    answer per change and patchset, so they aren't kept as snapshots, which
+    would only pile up.
+    """
+    if callable(watched):
+        with timed('gerrit_wait'):
+            watched = watched()
+    if not all(info.get('patchset') for info in watched.values()):
+        # We need to know the patchset to ask zuul about a change
+        return _get_zuul_status(watched, cache_ttl,
+                                ZUUL_URL + '/api/tenant/%s/status' % tenant)
+
+    urls = ['%s/api/tenant/%s/status/change/%i,%i' % (
+        ZUUL_URL, tenant, number, info['patchset'])
+        for number, info in watched.items()]
+    with _import('concurrent.futures').ThreadPoolExecutor(
+            max_workers=max(1, len(urls))) as pool:
+        futures = [_submit(pool, _get_zuul_status, url=url, snapshot=False)
+                   for url in urls]
+        items = [item for future in futures for item in future.result()]
+
+    pipelines = {}
+    for item in sorted(items, key=lambda i: i.get('enqueue_time') or 0):
+        jobs = item.get('jobs') or [{}]
+        name = jobs[0].get('pipeline', 'unknown')
+        pipelines.setdefault(name, []).append([item])
+    return {'pipelines': [{'name': name, 'change_queues': [{'heads': heads}]}
+                          for name, heads in pipelines.items()],
+            '_partial': True}
+
+
+def _filter_zuul_status(zuul_data, watched):
+    """Drop every head from zuul_data that has no watched change in it"""
+    watched_ids = _resolve_watched(watched)
+    for pipeline in zuul_data.get('pipelines', []):
+        for queue in pipeline.get('change_queues', []):
+            heads = queue['heads']
+            queue['heads'] = []
+            for head in heads:
+                _add_head(queue, head, watched_ids)
+    return zuul_data
+
+
+def _stream_zuul_status(stream, watched):
+    """Incrementally parse a zuul status document keeping only watched heads
+
+    This only ever holds one head in memory at a time (plus the heads that
+    matched), instead of the whole multi-megabyte document.
+    """
+    ijson = _import_ijson()
+    zuul_data = {'pipelines': []}
+    watched_ids = None
+    pipeline = queue = None
+    builder = target = None
+    depth = 0
+
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if event in ('start_map', 'start_array'):
+                depth += 1
+            elif event in ('end_map', 'end_array'):
+                depth -= 1
+            if depth:
+                continue
+            if target is None:
+                if watched_ids is None:
+                    watched_ids = _resolve_watched(watched)
+                _add_head(queue, builder.value, watched_ids)
+            else:
+                zuul_data[target] = builder.value
+            builder = None
+            continue
 
-    if zuul.info().get('Content-Encoding') == 'gzip':
-        buf = BytesIO(data)
-        f = gzip.GzipFile(fileobj=buf)
-        data = f.read()
+        if event in ('map_key', 'end_map', 'end_array'):
+            continue
+        if prefix == HEAD_PREFIX:
+            target = None
+        elif prefix == 'pipelines.item':
+            pipeline = {'change_queues': []}
+            zuul_data['pipelines'].append(pipeline)
+            continue
+        elif prefix == 'pipelines.item.name':
+            pipeline['name'] = value
+            continue
+        elif prefix == 'pipelines.item.change_queues.item':
+            queue = {'heads': []}
+            pipeline['change_queues'].append(queue)
+            continue
+        elif prefix and prefix != 'pipelines' and '.' not in prefix:
+            # Some other top-level item like the message or trigger queue
+            target = prefix
+        else:
+            continue
 
-    return json.loads(data)
+        builder = ijson.ObjectBuilder()
+        builder.event(event, value)
+        depth = 1 if event in ('start_map', 'start_array') else 0
+        if not depth:
+            zuul_data[target] = builder.value
+            builder = None
 
+    return zuul_data
 
-def get_zuul_status():
+
+def get_zuul_status(watched=None, cache_ttl=0, strategy='global',
+                    tenant=ZUUL_TENANT):
     try:
-        CACHE['zuul'] = _get_zuul_status()
+        if strategy == 'change':
+            CACHE['zuul'] = _get_zuul_changes(watched, cache_ttl, tenant)
+        elif strategy == 'tenant':
+            url = ZUUL_URL + '/api/tenant/%s/status' % tenant
+            CACHE['zuul'] = _get_zuul_status(watched, cache_ttl, url)
+        else:
+            CACHE['zuul'] = _get_zuul_status(watched, cache_ttl,
+                                             ZUUL_STATUS_URL)
         CACHE['zuul']['_retry'] = 0
     except Exception:
         try:
@@ -136,16 +1096,80 @@ def get_zuul_status():
 
 
 def dump_zuul():
-    pprint.pprint(get_zuul_status())
+    reset_timings()
+    _import('pprint').pprint(get_zuul_status())
+    print('Zuul: %s' % format_timings(), file=sys.stderr)
+
+
+class Record(object):
+    """A compact record that still allows the old dict-style access"""
+    __slots__ = ()
+
+    def __init__(self, *args):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                self._values() == other._values())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % item for item in zip(self.__slots__, self._values())))
+
+
+class Owner(Record):
+    __slots__ = ('account_id', 'username', 'name', 'email')
+
+    @classmethod
+    def from_dict(cls, owner, owners=None):
+        """Make an Owner, sharing one record per owner in owners if given"""
+        if not isinstance(owner, dict):
+            return owner
+        values = (owner.get('_account_id'), owner.get('username'),
+                  owner.get('name'), owner.get('email'))
+        if owners is None:
+            return cls(*values)
+        record = owners.get(values)
+        if record is None:
+            record = owners[values] = cls(*values)
+        return record
+
+
+class JobStatus(Record):
+    __slots__ = ('percent', 'status', 'okay')
+
+
+class QueueEntry(Record):
+    __slots__ = ('pos', 'id', 'subject', 'owner', 'starred', 'enqueue_time',
+                 'status')
 
 
 def get_change_ids(changes):
     change_ids = {}
+    # Only shared within one fetch, so names and emails stay current
+    owners = {}
     for thing in changes:
         change_ids[int(thing[u'number'])] = {
             'subject': thing[u'subject'],
-            'owner': thing[u'owner'],
+            'owner': Owner.from_dict(thing[u'owner'], owners),
             'starred': thing.get(u'starred'),
+            'patchset': thing.get(u'patchset'),
         }
     return change_ids
 
@@ -172,41 +1196,45 @@ def get_change_id(change):
     return change_id
 
 
+OKAY_STATUSES = frozenset(['SUCCESS'])
+MAYBE_STATUSES = frozenset(['SKIPPED', 'ABORTED', 'CANCELED'])
+
+
 def get_job_status(change):
-    total = 0
+    jobs = change['jobs']
+    if not jobs:
+        return JobStatus(0, '?', 'no')
     complete = 0
     okay = None
-    okay_statuses = ['SUCCESS']
-    maybe_statuses = ['SKIPPED', 'ABORTED', 'CANCELED']
-    status = ''
-    for job in change['jobs']:
-        total += 1
-        if job['result']:
+    status = []
+    for job in jobs:
+        result = job['result']
+        if result:
             complete += 1
             if job['voting']:
-                if job['result'] in okay_statuses:
+                if result in OKAY_STATUSES:
                     okay = 'yes' if okay is None else okay
-                    status += '+'
-                elif job['result'] in maybe_statuses:
+                    status.append('+')
+                elif result in MAYBE_STATUSES:
                     okay = 'maybe' if okay != 'no' else okay
-                    status += '?'
+                    status.append('?')
                 else:
                     okay = 'no'
-                    status += '-'
+                    status.append('-')
+        elif job.get('start_time'):
+            status.append('~')
         else:
-            if job['start_time']:
-                status += '~'
-            else:
-                status += '_'
-    if not total:
-        return 0, '?', 'no'
-    return (complete * 100) / total, status, okay
+            status.append('_')
+    return JobStatus(complete * 100 // len(jobs), ''.join(status), okay)
 
 
 def process_changes(head, change_ids, queue_pos, queue_results):
     # with Depends-On we can have heads in independent pipelines, but
     # we should ignore everything except the last change in them
     # unless this is really a dependent pipeline.
+    if len(head) == 1 and SKIP_KEY in head[0]:
+        # Placeholder for heads filtered out of the zuul data
+        return queue_pos + head[0][SKIP_KEY]
     if len(head) > 0 and not is_dependent_queue(head):
         head = [head[-1]]
 
@@ -215,79 +1243,153 @@ def process_changes(head, change_ids, queue_pos, queue_results):
         change_id = get_change_id(change)
         if change_id in change_ids:
             queue_results.append(
-                {'pos': queue_pos,
-                 'id': change['id'],
-                 'subject': change_ids[change_id]['subject'],
-                 'owner': change_ids[change_id]['owner'],
-                 'starred': change_ids[change_id].get('starred'),
-                 'enqueue_time': change['enqueue_time'],
-                 'status': get_job_status(change),
-                 })
+                make_queue_entry(queue_pos, change, change_ids[change_id]))
     return queue_pos
 
 
+def make_queue_entry(queue_pos, change, info):
+    return QueueEntry(queue_pos, change['id'], info['subject'], info['owner'],
+                      info.get('starred'), change['enqueue_time'],
+                      get_job_status(change))
+
+
+def add_labels(auth_creds, changes, numbers):
+    """Fetch the current labels of some of changes, adding them in place
+
+    This is the second, much smaller, query for the changes that -j shows.
+    """
+    wanted = [change for change in changes if change['number'] in numbers]
+    if not wanted:
+        return
+    filters = {'change': [str(change['number']) for change in wanted]}
+    try:
+        detailed = get_pending_changes(auth_creds, filters, 'OR', [], None,
+                                       status=None, options=LABEL_OPTIONS)
+    except Exception as e:
+        error('Failed to get labels from Gerrit: %s' % e)
+        return
+    detailed = dict((change['number'], change) for change in detailed)
+    for change in wanted:
+        if change['number'] in detailed:
+            change['labels'] = detailed[change['number']].get('labels', {})
+            change['patchset'] = detailed[change['number']].get('patchset')
+
+
 def get_jenkins_info(changes):
     jenkins_info = []
     for change in changes:
-        patch_set = change['currentPatchSet']
-        change_id = '%s,%s' % (change['number'], patch_set['number'])
-        for approval in patch_set.get('approvals', []):
-            if (approval['type'] != 'VRIF' or
-                    approval['by'].get('username') != 'jenkins'):
+        change_id = str(change['number'])
+        if change.get('patchset') is not None:
+            change_id += ',%s' % change['patchset']
+        verified = change.get('labels', {}).get('Verified', {})
+        for approval in verified.get('all', []):
+            if (approval.get('username') not in CI_USERS or
+                    not approval.get('value')):
                 continue
-            score = approval['value']
+            score = '%i' % approval['value']
             break
         else:
             score = '0'
         jenkins_info.append({'id': change_id,
                              'score': score,
-                             'owner': change['owner'],
+                             'owner': Owner.from_dict(change['owner']),
                              'subject': change['subject']})
     return jenkins_info
 
 
-def find_changes_in_zuul(zuul_data, changes, ignore_queues):
-    change_ids = get_change_ids(changes)
+def index_zuul_status(zuul_data, ignore_queues):
+    """Map change numbers to their (queue, position, item) entries in zuul
 
-    results = {}
-    queue_stats = {}
+    This walks the zuul data once. The index is kept until we get a new
+    snapshot from zuul, so matching against an unchanged snapshot (for
+    example after a 304) doesn't walk it again.
+    """
+    ignored = set(IGNORE_QUEUES + ignore_queues)
+    cached = CACHE.get('zuul_index')
+    if cached and cached[0] is zuul_data and cached[1] == ignored:
+        return cached[2], cached[3]
 
+    index = {}
+    queue_stats = {}
     for queue in zuul_data['pipelines']:
         queue_name = queue['name']
-        if queue_name in IGNORE_QUEUES + ignore_queues:
+        if queue_name in ignored:
             continue
         queue_pos = 0
-        results[queue_name] = []
         for subq in queue['change_queues']:
             for head in subq['heads']:
-                queue_pos = process_changes(head, change_ids,
-                                            queue_pos,
-                                            results[queue_name])
+                if len(head) == 1 and SKIP_KEY in head[0]:
+                    queue_pos += head[0][SKIP_KEY]
+                    continue
+                # See process_changes()
+                if len(head) > 0 and not is_dependent_queue(head):
+                    head = [head[-1]]
+                for change in head:
+                    queue_pos += 1
+                    change_id = get_change_id(change)
+                    if change_id is not False:
+                        index.setdefault(change_id, []).append(
+                            (queue_name, queue_pos, change))
         queue_stats[queue_name] = queue_pos
+
+    CACHE['zuul_index'] = (zuul_data, ignored, index, queue_stats)
+    return index, queue_stats
+
+
+def match_changes_in_zuul(zuul_data, changes, ignore_queues):
+    """Find the changes in zuul
+
+    Returns the per-queue results and queue lengths like
+    find_changes_in_zuul(), plus the set of change numbers that are not in
+    zuul at all.
+    """
+    change_ids = get_change_ids(changes)
+    index, queue_stats = index_zuul_status(zuul_data, ignore_queues)
+
+    results = dict((queue_name, []) for queue_name in queue_stats)
+    found = set(change_ids).intersection(index)
+    for change_id in found:
+        for queue_name, queue_pos, change in index[change_id]:
+            results[queue_name].append(
+                make_queue_entry(queue_pos, change, change_ids[change_id]))
+    for queue_results in results.values():
+        queue_results.sort(key=lambda entry: entry.pos)
+    return results, queue_stats, set(change_ids) - found
+
+
+def find_changes_in_zuul(zuul_data, changes, ignore_queues):
+    results, queue_stats, _ = match_changes_in_zuul(zuul_data, changes,
+                                                    ignore_queues)
     return results, queue_stats
 
 
 def green_line(line):
+    colorama = _import('colorama')
     return colorama.Fore.GREEN + line + colorama.Fore.RESET
 
 
 def yellow_line(line):
+    colorama = _import('colorama')
     return colorama.Fore.YELLOW + line + colorama.Fore.RESET
 
 
 def red_line(line):
+    colorama = _import('colorama')
     return colorama.Fore.RED + line + colorama.Fore.RESET
 
 
 def blue_line(line):
+    colorama = _import('colorama')
     return colorama.Fore.LIGHTBLUE_EX + line + colorama.Fore.RESET
 
 
 def bright_line(line):
+    colorama = _import('colorama')
     return colorama.Style.BRIGHT + line + colorama.Style.RESET_ALL
 
 
 def red_background_line(line):
+    colorama = _import('colorama')
     return (colorama.Back.RED + colorama.Style.BRIGHT + line +
             colorama.Style.RESET_ALL + colorama.Back.RESET)
 
@@ -303,15 +1405,15 @@ def format_time(secs):
 
 
 def calculate_time_in_queue(change):
-    enqueue_timestamp = int(change['enqueue_time']) / 1000
+    enqueue_timestamp = int(change.enqueue_time) / 1000
     secs = time.time() - enqueue_timestamp
     return format_time(secs)
 
 
 def calculate_time_remaining(change):
-    enqueue_timestamp = int(change['enqueue_time']) / 1000
+    enqueue_timestamp = int(change.enqueue_time) / 1000
     secs = time.time() - enqueue_timestamp
-    percent_done = change['status'][0]
+    percent_done = change.status.percent
     if percent_done != 0:
         total_time = int(float(secs) * 100. / float(percent_done))
         return format_time(total_time - secs)
@@ -319,153 +1421,978 @@ def calculate_time_remaining(change):
         return '?m'
 
 
+class RefreshScheduler(object):
+    """Work out how long to wait before the next refresh
+
+    After failures (ours, or zuul's as counted in _retry) we back off
+    exponentially. With adaptive set we also slow down while nothing
+    changes in what we show, and go back to the base interval (or faster)
+    when watched changes have jobs running or are near the head of the
+    gate. Every interval gets some jitter so that many dashboards don't
+    end up polling in lockstep.
+    """
+    JITTER = 0.1
+    BACKOFF = 2
+    # However long an outage goes on, keep retrying at least this often
+    MAX_BACKOFF = 300
+    SLOWDOWN = 1.5
+    GATE_HEAD = 3
+
+    def __init__(self, base, adaptive=False, max_interval=None):
+        self.base = base
+        self.adaptive = adaptive
+        self.max_interval = max_interval or max(base * 10, 300)
+        self.min_interval = max(base / 2.0, 1)
+        self.failures = 0
+        self.unchanged = 0
+        self.interval = base
+        self._fingerprint = None
+
+    def _jitter(self, interval):
+        interval = min(interval, self.max_interval)
+        return interval * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+
+    def failed(self, failures=None):
+        self.failures = failures or self.failures + 1
+        # The exponent is capped too, so it can't overflow a float
+        backoff = self.base * self.BACKOFF ** min(self.failures, 32)
+        self.interval = self._jitter(min(backoff,
+                                         max(self.base, self.MAX_BACKOFF)))
+        return self.interval
+
+    def succeeded(self, results, zuul_data=None):
+        retry = (zuul_data or {}).get('_retry')
+        if retry:
+            # We are showing stale zuul data
+            return self.failed(retry)
+        self.failures = 0
+        if not self.adaptive:
+            self.interval = self._jitter(self.base)
+            return self.interval
+
+        fingerprint = []
+        busy = False
+        for queue, entries in results.items():
+            for entry in entries:
+                fingerprint.append((queue, entry.id, entry.pos,
+                                    entry.status.status))
+                if '~' in entry.status.status or (
+                        queue == 'gate' and entry.pos <= self.GATE_HEAD):
+                    busy = True
+        fingerprint = sorted(fingerprint)
+        if fingerprint == self._fingerprint:
+            self.unchanged += 1
+        else:
+            self.unchanged = 0
+        self._fingerprint = fingerprint
+
+        if busy:
+            interval = self.min_interval
+        else:
+            interval = self.base * self.SLOWDOWN ** self.unchanged
+        self.interval = self._jitter(interval)
+        return self.interval
+
+    def status(self):
+        msg = 'Next refresh in %s' % format_time(self.interval)
+        if self.failures:
+            msg += ' (retry %i)' % self.failures
+        return msg
+
+
 def error(msg):
     _reset_terminal()
     print(red_background_line(msg))
 
 
-def do_trigger_line(zuul_data):
+def refresh_failed(msg, renderer=None, scheduler=None):
+    """Say why a refresh failed, and when the next attempt will be"""
+    if renderer is not None:
+        renderer.invalidate()
+    if scheduler is not None:
+        scheduler.failed()
+    error(msg)
+    if scheduler is not None:
+        print(yellow_line(scheduler.status()))
+
+
+def trigger_lines(zuul_data, scheduler=None):
+    lines = []
     try:
         trigger_queue = zuul_data['trigger_event_queue']['length']
         msg = "Backlog: %i items" % trigger_queue
         if trigger_queue > 20:
-            print(red_background_line(msg))
+            lines.append(red_background_line(msg))
         elif trigger_queue > 10:
-            print(yellow_line(msg))
+            lines.append(yellow_line(msg))
         elif trigger_queue > 5:
-            print(msg)
+            lines.append(msg)
     except:
         pass
 
     try:
         retry = zuul_data['_retry']
         if retry > 0:
-            print(yellow_line('%i failed attempts' % retry))
+            lines.append(yellow_line('%i failed attempts' % retry))
     except:
         pass
 
+    if scheduler is not None:
+        line = scheduler.status()
+        lines.append(yellow_line(line) if scheduler.failures else line)
+    return lines
+
+
+def do_trigger_line(zuul_data):
+    for line in trigger_lines(zuul_data):
+        print(line)
+
+
+def _fetch_dashboard_data(auth_creds, user, filters, operator, projects,
+                          query, stream_zuul, zuul_cache_ttl, incremental,
+                          resync, zuul_strategy, zuul_tenant, gerrit_cache):
+    # Gerrit and Zuul are independent, so fetch them at the same time and
+    # only wait for the slower of the two.
+    pool = _import('concurrent.futures').ThreadPoolExecutor(max_workers=3)
+    account_future = _submit(pool, get_account_id, auth_creds, user)
+    options = GERRIT_OPTIONS
+    if zuul_strategy == 'change':
+        # We need the patchset to ask zuul about each change
+        options += ('CURRENT_REVISION',)
+    if incremental:
+        gerrit_future = _submit(pool, get_changes_incremental, auth_creds,
+                                filters, operator, projects, query,
+                                resync, options)
+    elif gerrit_cache is not None:
+        gerrit_future = _submit(pool, gerrit_cache.get_pending_changes,
+                                auth_creds, filters, operator, projects,
+                                query, options=options)
+    else:
+        gerrit_future = _submit(pool, get_pending_changes, auth_creds,
+                                filters, operator, projects, query,
+                                options=options)
+    watched = None
+    if stream_zuul or zuul_strategy == 'change':
+        # Only keep the zuul data for changes gerrit tells us about
+        def watched():
+            changes = gerrit_future.result(timeout=GERRIT_TIMEOUT)
+            return get_change_ids(changes)
+    zuul_future = _submit(pool, get_zuul_status, watched, zuul_cache_ttl,
+                          zuul_strategy, zuul_tenant)
+    # Don't block on a straggler after we have given up on it
+    pool.shutdown(wait=False)
+    return gerrit_future, zuul_future, account_future
+
 
 def do_dashboard(auth_creds, user, filters, reset, show_jenkins, operator,
-                 projects, query, ignore_queues):
+                 projects, query, ignore_queues, stream_zuul=False,
+                 zuul_cache_ttl=0, incremental=False,
+                 resync=GERRIT_RESYNC, zuul_strategy='global',
+                 zuul_tenant=ZUUL_TENANT, renderer=None, scheduler=None,
+                 timings=False, gerrit_cache=None, recorder=None,
+                 snapshot=None):
+    reset_timings()
+    if snapshot is not None:
+        Future = _import('concurrent.futures').Future
+        # Replaying what was recorded before rather than asking anyone
+        gerrit_future = Future()
+        gerrit_future.set_result(snapshot[0])
+        zuul_future = Future()
+        zuul_future.set_result(snapshot[1])
+        account_future = Future()
+        account_future.set_result(None)
+    else:
+        gerrit_future, zuul_future, account_future = _fetch_dashboard_data(
+            auth_creds, user, filters, operator, projects, query, stream_zuul,
+            zuul_cache_ttl, incremental, resync, zuul_strategy, zuul_tenant,
+            gerrit_cache)
     try:
-        changes = get_pending_changes(auth_creds, filters, operator, projects, query)
+        changes = gerrit_future.result(timeout=GERRIT_TIMEOUT)
     except Exception as e:
-        error('Failed to get changes from Gerrit: %s' % e)
+        refresh_failed('Failed to get changes from Gerrit: %s' % e,
+                       renderer, scheduler)
         return
     try:
-        zuul_data = get_zuul_status()
-        results, queue_stats = find_changes_in_zuul(zuul_data, changes, ignore_queues)
+        zuul_data = zuul_future.result(timeout=ZUUL_TIMEOUT)
+        with timed('match'):
+            results, queue_stats, not_found = match_changes_in_zuul(
+                zuul_data, changes, ignore_queues)
+    except Exception as e:
+        refresh_failed('Failed to get data from Zuul: %s' % e, renderer,
+                       scheduler)
+        return
+
+    if show_jenkins and not_found and snapshot is None:
+        add_labels(auth_creds, changes, not_found)
+    if recorder is not None:
+        recorder.record(gerrit=changes, zuul=zuul_data)
+    if scheduler is not None:
+        scheduler.succeeded(results, zuul_data)
+    account_future.result(timeout=GERRIT_TIMEOUT)
+    with timed('render'):
+        lines = render_dashboard(user, show_jenkins, changes, zuul_data,
+                                 results, queue_stats, not_found,
+                                 scheduler=scheduler)
+    lines.extend(account_lines(user))
+    if timings:
+        lines.extend(timing_lines())
+    TIMINGS.pop('output', None)
+    with timed('output'):
+        if renderer is not None:
+            renderer.render([dashboard_header(filters, operator, projects)] +
+                            lines)
+            return
+        if reset:
+            reset_terminal(filters, operator, projects)
+        for line in lines:
+            print(line)
+
+
+def do_profiles_dashboard(auth_creds, user, profiles, reset,
+                          stream_zuul=False, zuul_cache_ttl=0,
+                          incremental=False, resync=GERRIT_RESYNC,
+                          zuul_strategy='tenant', zuul_tenant=ZUUL_TENANT,
+                          renderer=None, scheduler=None, timings=False,
+                          gerrit_cache=None):
+    """Show several filter sets from one zuul fetch as sections of a screen
+
+    The gerrit queries for all the profiles run concurrently, and all of
+    them are matched against the same zuul snapshot.
+    """
+    reset_timings()
+    pool = _import('concurrent.futures').ThreadPoolExecutor(
+        max_workers=len(profiles) + 2)
+    account_future = _submit(pool, get_account_id, auth_creds, user)
+    gerrit_futures = []
+    for profile in profiles:
+        filters, projects = make_filters(profile)
+        operator = query_operator(filters, profile.operator)
+        if incremental:
+            future = _submit(pool, get_changes_incremental, auth_creds,
+                             filters, operator, projects, profile.query,
+                             resync)
+        elif gerrit_cache is not None:
+            future = _submit(pool, gerrit_cache.get_pending_changes,
+                             auth_creds, filters, operator, projects,
+                             profile.query)
+        else:
+            future = _submit(pool, get_pending_changes, auth_creds, filters,
+                             operator, projects, profile.query)
+        gerrit_futures.append(future)
+    watched = None
+    if stream_zuul:
+        # Keep the zuul data for the changes of every profile
+        def watched():
+            change_ids = {}
+            for future in gerrit_futures:
+                change_ids.update(get_change_ids(
+                    future.result(timeout=GERRIT_TIMEOUT)))
+            return change_ids
+    if zuul_strategy in ('auto', 'change'):
+        # One status for everything is the whole point here
+        zuul_strategy = 'tenant'
+    zuul_future = _submit(pool, get_zuul_status, watched, zuul_cache_ttl,
+                          zuul_strategy, zuul_tenant)
+    pool.shutdown(wait=False)
+    try:
+        zuul_data = zuul_future.result(timeout=ZUUL_TIMEOUT)
+        if zuul_data is None:
+            raise ValueError('no status available')
     except Exception as e:
-        error('Failed to get data from Zuul: %s' % e)
+        refresh_failed('Failed to get data from Zuul: %s' % e, renderer,
+                       scheduler)
         return
 
-    if reset:
-        reset_terminal(filters, operator, projects)
+    sections = []
+    all_results = {}
+    for profile, future in zip(profiles, gerrit_futures):
+        sections.append(bright_line('== %s ==' % profile.name))
+        try:
+            changes = future.result(timeout=GERRIT_TIMEOUT)
+        except Exception as e:
+            sections.append(red_background_line(
+                'Failed to get changes from Gerrit: %s' % e))
+            continue
+        with timed('match'):
+            results, queue_stats, not_found = match_changes_in_zuul(
+                zuul_data, changes, profile.ignore_queue)
+        for queue, entries in results.items():
+            all_results.setdefault(queue, []).extend(entries)
+        if profile.jenkins and not_found:
+            add_labels(auth_creds, changes, not_found)
+        account_future.result(timeout=GERRIT_TIMEOUT)
+        with timed('render'):
+            sections.extend(render_dashboard(user, profile.jenkins, changes,
+                                             zuul_data, results, queue_stats,
+                                             not_found, status=False))
+
+    if scheduler is not None:
+        scheduler.succeeded(all_results, zuul_data)
+    lines = status_lines(zuul_data, scheduler) + sections
+    lines.extend(account_lines(user))
+    if timings:
+        lines.extend(timing_lines())
+
+    header = 'Dashboard for %s - %s ' % (
+        ', '.join(profile.name for profile in profiles), time.asctime())
+    TIMINGS.pop('output', None)
+    with timed('output'):
+        if renderer is not None:
+            renderer.render([header] + lines)
+            return
+        if reset:
+            _reset_terminal()
+            print(header)
+        for line in lines:
+            print(line)
+
+
+def status_lines(zuul_data, scheduler=None):
+    lines = []
     if u'message' in zuul_data:
         msg = re.sub('<[^>]+>', '', zuul_data['message'])
-        print(red_background_line('Zuul: %s' % msg))
-    do_trigger_line(zuul_data)
-    change_ids_not_found = list(get_change_ids(changes).keys())
+        lines.append(red_background_line('Zuul: %s' % msg))
+    lines.extend(trigger_lines(zuul_data, scheduler))
+    return lines
+
+
+def render_dashboard(user, show_jenkins, changes, zuul_data, results,
+                     queue_stats, not_found, status=True, scheduler=None):
+    lines = status_lines(zuul_data, scheduler) if status else []
+    # With a partial status we don't know the queue lengths or positions
+    partial = zuul_data.get('_partial')
     for queue, zuul_info in results.items():
         if zuul_info:
-            print(bright_line("Queue: %s (%i/%i)" % (queue, len(zuul_info),
-                                                     queue_stats[queue])))
+            if partial:
+                lines.append(bright_line("Queue: %s (%i)" % (
+                    queue, len(zuul_info))))
+            else:
+                lines.append(bright_line("Queue: %s (%i/%i)" % (
+                    queue, len(zuul_info), queue_stats[queue])))
             for change in zuul_info:
-                change_id = get_change_id(change)
-                if change_id in change_ids_not_found:
-                    change_ids_not_found.remove(change_id)
                 time_in_q = calculate_time_in_queue(change)
                 time_remaining = calculate_time_remaining(change)
-                percent, status, okay = change['status']
+                status = change.status.status
+                okay = change.status.okay
                 line = '(%-8s) %s (%s/%s/rem:%s)' % (
-                    change['id'],
-                    change['subject'],
+                    change.id,
+                    change.subject,
                     time_in_q,
                     status,
                     time_remaining)
-                if queue == 'gate':
-                    line = ('%3i: ' % change['pos']) + line
+                if queue == 'gate' and not partial:
+                    line = ('%3i: ' % change.pos) + line
                 else:
                     line = '     ' + line
-                if change['owner'].get('username') == user:
+                if is_user(change.owner, user):
                     if okay in ['yes', None]:
-                        print(green_line(line))
+                        lines.append(green_line(line))
                     elif okay == 'maybe':
-                        print(yellow_line(line))
+                        lines.append(yellow_line(line))
                     elif status == '?':
                         # status == ? means the patch is queued but
                         # no executor is available
-                        print(line)
+                        lines.append(line)
                     else:
-                        print(red_line(line))
-                elif change.get('starred'):
-                    print(blue_line(line))
+                        lines.append(red_line(line))
+                elif change.starred:
+                    lines.append(blue_line(line))
                 elif status != '?':
-                    print(line)
+                    lines.append(line)
     # Show info about changes not in zuul.
-    if show_jenkins and change_ids_not_found:
-        print("Jenkins scores:")
+    if show_jenkins and not_found:
+        lines.append("Jenkins scores:")
         changes_not_found = [x for x in changes
-                             if int(x['number']) in change_ids_not_found]
+                             if int(x['number']) in not_found]
         jenkins_info = get_jenkins_info(changes_not_found)
         for info in jenkins_info:
             line = " %2s: (%-8s) %s" % (info['score'], info['id'],
                                         info['subject'])
-            if info['owner']['username'] == user:
-                print(green_line(line))
+            if is_user(info['owner'], user):
+                lines.append(green_line(line))
             else:
-                print(line)
+                lines.append(line)
+    return lines
 
 
 def _reset_terminal():
     print("\033c", end='')
 
 
-def reset_terminal(filters, operator, projects):
+def dashboard_header(filters, operator, projects):
     if operator == 'OR':
         delim = '+'
     else:
         delim = ','
-    _reset_terminal()
     target = delim.join('%s:%s' % (x, y) for x, y in filters.items())
-    print("Dashboard for %s %s - %s " % (target, projects, time.asctime()))
-
-
-def osloconfig_parse(args, cfg):
-    config_files = []
-    path = os.environ.get('DASH_CONFIG_FILE', 'dash.conf')
-    if os.path.exists(path):
-        config_files.append(path)
-
-    default_opts = []
-    for opt in args:
-        if opt.action in ('store_true', 'store_false'):
-            o = cfg.BoolOpt(opt.dest,
-                            short=opt._short_opts[0][1],
-                            default=opt.default,
-                            help=opt.help)
-        elif opt.type == 'int':
-            o = cfg.IntOpt(opt.dest,
-                           short=opt._short_opts[0][1],
-                           default=opt.default,
-                           help=opt.help)
-        elif opt.dest:
-            o = cfg.StrOpt(opt.dest,
-                           short=opt._short_opts[0][1],
-                           default=opt.default,
-                           help=opt.help)
+    return "Dashboard for %s %s - %s " % (target, projects, time.asctime())
+
+
+def reset_terminal(filters, operator, projects):
+    _reset_terminal()
+    print(dashboard_header(filters, operator, projects))
+
+
+ANSI_ESCAPE = re.compile('(\033\\[[0-9;]*[A-Za-z])')
+
+
+def truncate_line(line, width):
+    """Cut a line down to width visible characters, keeping color codes"""
+    if len(line) <= width:
+        return line
+    out = []
+    for part in ANSI_ESCAPE.split(line):
+        if ANSI_ESCAPE.match(part):
+            out.append(part)
+        elif width > 0:
+            out.append(part[:width])
+            width -= len(part)
+    return ''.join(out) + _import('colorama').Style.RESET_ALL
+
+
+class DiffRenderer(object):
+    """Redraw only the lines of the screen that changed since last time
+
+    The first line of each frame is kept as a header. If the rest doesn't
+    fit in the terminal, as much of it as does is shown, with a footer
+    saying how much that is. It is always the top, as a page that moved
+    on by itself would change every line and leave nothing to save.
+    """
+
+    def __init__(self, stream=None):
+        self._stream = stream or sys.stdout
+        self._screen = None
+
+    def invalidate(self):
+        """Forget what is on the screen, so the next frame is drawn in full"""
+        self._screen = None
+
+    def _viewport(self, frame, width, height):
+        header, body = frame[:max(height, 0)][:1], frame[1:]
+        rows = height - len(header)
+        if len(body) > rows:
+            # Leave room for a footer saying how much is missing
+            rows -= 1
+            footer = ['-- %i of %i lines --' % (max(rows, 0), len(body))]
+            body = body[:max(rows, 0)] + footer[:max(rows + 1, 0)]
+        return [truncate_line(line, width) for line in header + body]
+
+    def render(self, frame):
+        size = shutil.get_terminal_size()
+        screen = self._viewport(frame, size.columns, size.lines)
+        out = []
+        if self._screen is None:
+            out.append('\033[H\033[2J')
+            previous = []
+        else:
+            previous = self._screen
+        for row, line in enumerate(screen):
+            if row >= len(previous) or previous[row] != line:
+                out.append('\033[%i;1H%s\033[K' % (row + 1, line))
+        for row in range(len(screen), len(previous)):
+            out.append('\033[%i;1H\033[K' % (row + 1))
+        # Park the cursor below what we drew, without scrolling
+        out.append('\033[%i;1H' % min(len(screen) + 1, size.lines))
+        self._stream.write(''.join(out))
+        self._stream.flush()
+        self._screen = screen
+
+
+def _json_lines(data):
+    # Indenting would give nicer lines, but then json can't use its C
+    # encoder. Splitting at the separators is just as reversible.
+    return json.dumps(data, sort_keys=True).split(', ')
+
+
+def _json_unlines(lines):
+    return json.loads(', '.join(lines))
+
+
+def make_delta(old, new):
+    """Describe the lines of new as runs of lines from old and new lines
+
+    Each op is either a [start, count] run to copy from old or a literal
+    line. Runs are picked greedily, preferring to carry on from where the
+    last one ended so that common lines like "}," match in the right place.
+    """
+    index = {}
+    for i, line in enumerate(old):
+        index.setdefault(line, []).append(i)
+    ops = []
+    pos = j = 0
+    while j < len(new):
+        if pos < len(old) and old[pos] == new[j]:
+            start = pos
+        else:
+            candidates = index.get(new[j])
+            if not candidates:
+                ops.append(new[j])
+                j += 1
+                continue
+            k = bisect.bisect_left(candidates, pos)
+            start = candidates[min(k, len(candidates) - 1)]
+        end = start + 1
+        while end < len(old) and j + end - start < len(new):
+            # Compare a slice at a time while the lines keep matching
+            k = j + end - start
+            n = min(64, len(old) - end, len(new) - k)
+            if old[end:end + n] == new[k:k + n]:
+                end += n
+                continue
+            while old[end] == new[j + end - start]:
+                end += 1
+            break
+        if end - start == 1:
+            ops.append(new[j])
+        else:
+            ops.append([start, end - start])
+        pos = end
+        j += end - start
+    return ops
+
+
+def apply_delta(old, ops):
+    new = []
+    for op in ops:
+        if isinstance(op, list):
+            new.extend(old[op[0]:op[0] + op[1]])
         else:
+            new.append(op)
+    return new
+
+
+class Recorder(object):
+    """Append what each refresh got from gerrit and zuul to an archive
+
+    The archive is a directory of gzipped segments, one JSON record per
+    line. The first record of a segment has the full data and the rest only
+    have deltas against the record before, as one zuul status is mostly the
+    same as the last. Each record is flushed as it is written, so a segment
+    can be replayed while it is still being recorded.
+    """
+
+    def __init__(self, directory, segment_size=RECORD_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._file = None
+        self._count = 0
+        self._last = {}
+
+    def _open(self):
+        self.close()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        stamp = int(time.time() * 1000)
+        while True:
+            # Named so that segments sort in the order they were recorded
+            path = os.path.join(self.directory, 'dash-%013i.jsonl.gz' % stamp)
+            if not os.path.exists(path):
+                break
+            stamp += 1
+        self._file = _import('gzip').open(path, 'wb')
+        self._count = 0
+        self._last = {}
+
+    def record(self, **snapshots):
+        if self._file is None or self._count >= self.segment_size:
+            self._open()
+        record = {'time': time.time()}
+        for kind, data in snapshots.items():
+            lines = _json_lines(data)
+            if kind in self._last:
+                record[kind] = {'delta': make_delta(self._last[kind], lines)}
+            else:
+                record[kind] = {'data': data}
+            self._last[kind] = lines
+        self._file.write((json.dumps(record) + '\n').encode('utf-8'))
+        self._file.flush(_import('zlib').Z_SYNC_FLUSH)
+        self._count += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def replay_records(directory):
+    """Yield the records written by a Recorder, with their deltas applied"""
+    gzip = _import('gzip')
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith('dash-') and name.endswith('.jsonl.gz')):
             continue
-        default_opts.append(o)
+        last = {}
+        with gzip.open(os.path.join(directory, name), 'rb') as f:
+            try:
+                for line in f:
+                    record = json.loads(line.decode('utf-8'))
+                    for kind, entry in list(record.items()):
+                        if kind == 'time':
+                            continue
+                        if 'data' in entry:
+                            record[kind] = entry['data']
+                            last[kind] = _json_lines(entry['data'])
+                        else:
+                            last[kind] = apply_delta(last[kind],
+                                                     entry['delta'])
+                            record[kind] = _json_unlines(last[kind])
+                    yield record
+            except (EOFError, ValueError):
+                # The end of a segment that is still being recorded, or
+                # whose recorder died
+                continue
 
-    conf = cfg.ConfigOpts()
-    for opt in default_opts:
-        conf.register_cli_opt(opt)
-    conf(args, project='dash', default_config_files=config_files)
-    return conf
+
+# The options a thin client passes on to the daemon
+CLIENT_OPTS = ('user', 'owner', 'change', 'projects', 'topic', 'query',
+               'watched', 'starred', 'operator', 'jenkins', 'ignore_queue')
+LIST_OPTS = ('change', 'ignore_queue')
+BOOL_OPTS = ('watched', 'starred', 'jenkins')
+# The daemon asks gerrit as itself, so these would be its stars and watches
+# rather than the client's, and any query at all with its credentials
+DAEMON_REFUSED_OPTS = ('query', 'watched', 'starred')
+# The daemon keeps the fetches for this many distinct queries, and the
+# dashboards rendered for this many option sets, dropping the least
+# recently used.
+DAEMON_CACHE_SIZE = 100
+# Dashboards show how long ago things happened, so a rendered one is only
+# reused for this many seconds even if there is no new data.
+DAEMON_RENDER_TTL = 1
+
+
+def opts_to_params(opts):
+    params = []
+    for name in CLIENT_OPTS:
+        value = getattr(opts, name)
+        if name in LIST_OPTS:
+            params.extend((name, v) for v in value or [])
+        elif name in BOOL_OPTS:
+            if value:
+                params.append((name, '1'))
+        elif value is not None:
+            params.append((name, value))
+    return params
+
+
+def params_to_opts(params):
+    for name in DAEMON_REFUSED_OPTS:
+        value = params.get(name, [''])[-1]
+        if value == '1' if name in BOOL_OPTS else value:
+            raise ValueError('--%s is not supported by a shared daemon' %
+                             name)
+    opts = argparse.Namespace(owner=None, topic=None, query=None,
+                              user=None, projects='', operator='AND')
+    for name in CLIENT_OPTS:
+        if name in LIST_OPTS:
+            setattr(opts, name, params.get(name) or
+                    (None if name == 'change' else []))
+        elif name in BOOL_OPTS:
+            setattr(opts, name, params.get(name, [''])[-1] == '1')
+        elif name in params:
+            setattr(opts, name, params[name][-1])
+    return opts
+
+
+class DashboardDaemon(object):
+    """Serve dashboards for many users from one set of zuul/gerrit polls
+
+    Zuul is fetched at most once per interval no matter how many clients
+    ask, and each distinct gerrit query likewise. Concurrent requests for
+    the same thing wait on the same fetch. Rendered dashboards are reused
+    until there is new data, for up to DAEMON_RENDER_TTL seconds.
+    """
+
+    def __init__(self, auth_creds, interval, zuul_tenant=ZUUL_TENANT,
+                 zuul_strategy='tenant'):
+        self._auth_creds = auth_creds
+        self._interval = interval
+        self._zuul_tenant = zuul_tenant
+        self._zuul_strategy = zuul_strategy
+        self._lock = threading.Lock()
+        self._pool = _import('concurrent.futures').ThreadPoolExecutor(
+            max_workers=GERRIT_WORKERS)
+        self._fetches = {}
+        self._rendered = {}
+
+    def _coalesce(self, key, fetch, *args):
+        """Return a future for fetch(*args), shared with other callers
+
+        A successful fetch is reused until it is interval seconds old.
+        """
+        with self._lock:
+            # Taken out and put back, so it is the most recently used
+            entry = self._fetches.pop(key, None)
+            now = time.time()
+            # Failures are retried by the next caller rather than kept
+            if (entry is None or (entry[0].done() and
+                                  (entry[0].exception() is not None or
+                                   now - entry[1] >= self._interval))):
+                entry = (self._pool.submit(fetch, *args), now)
+            self._fetches[key] = entry
+            for old in self._evict(self._fetches):
+                if old[0] == 'gerrit':
+                    # And what get_changes_incremental() knows about it
+                    CACHE.get('gerrit', {}).pop(old[1:], None)
+            return entry[0]
+
+    @staticmethod
+    def _evict(cache):
+        """Drop the least recently used entries past DAEMON_CACHE_SIZE"""
+        evicted = []
+        while len(cache) > DAEMON_CACHE_SIZE:
+            key = next(iter(cache))
+            del cache[key]
+            evicted.append(key)
+        return evicted
+
+    def _zuul_status(self):
+        return self._coalesce(('zuul',), get_zuul_status, None, 0,
+                              self._zuul_strategy, self._zuul_tenant)
+
+    def _changes(self, filters, operator, projects, query):
+        key = ('gerrit',) + tuple(build_queries(filters, operator, projects,
+                                                query))
+        return self._coalesce(key, get_changes_incremental,
+                              self._auth_creds, filters, operator,
+                              projects, query)
+
+    def dashboard(self, opts):
+        """Render the dashboard for a client's options"""
+        filters, projects = make_filters(opts)
+        operator = query_operator(filters, opts.operator)
+        zuul_future = self._zuul_status()
+        gerrit_future = self._changes(filters, operator, projects, opts.query)
+        try:
+            changes = gerrit_future.result()
+        except Exception as e:
+            return [red_background_line(
+                'Failed to get changes from Gerrit: %s' % e)]
+        try:
+            zuul_data = zuul_future.result()
+            results, queue_stats, not_found = match_changes_in_zuul(
+                zuul_data, changes, opts.ignore_queue)
+        except Exception as e:
+            return [red_background_line(
+                'Failed to get data from Zuul: %s' % e)]
+
+        key = repr(opts_to_params(opts))
+        with self._lock:
+            cached = self._rendered.pop(key, None)
+            if cached:
+                self._rendered[key] = cached
+                if (cached[0] is zuul_data and cached[1] is changes and
+                        time.time() - cached[3] < DAEMON_RENDER_TTL):
+                    return cached[2]
+        self._coalesce(('account', opts.user), get_account_id,
+                       self._auth_creds, opts.user).result()
+        if opts.jenkins and not_found:
+            # The changes are shared with other clients, so label copies
+            changes = [dict(change) if change['number'] in not_found
+                       else change for change in changes]
+            add_labels(self._auth_creds, changes, not_found)
+        lines = [dashboard_header(filters, operator, projects)]
+        lines.extend(render_dashboard(opts.user, opts.jenkins, changes,
+                                      zuul_data, results, queue_stats,
+                                      not_found))
+        lines.extend(account_lines(opts.user))
+        with self._lock:
+            self._rendered.pop(key, None)
+            self._rendered[key] = (zuul_data, changes, lines, time.time())
+            self._evict(self._rendered)
+        return lines
+
+
+def _is_unix_address(address):
+    """Whether address is a unix socket path rather than a [host]:port"""
+    _, sep, port = address.rpartition(':')
+    return '/' in address or not (sep and port.isdigit())
+
+
+class DashboardHandler(object):
+    """What the daemon serves, mixed into http.server's request handler"""
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        if url.path != '/dashboard':
+            self.send_error(404)
+            return
+        try:
+            opts = params_to_opts(urlparse.parse_qs(url.query))
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        body = ('\n'.join(self.server.daemon.dashboard(opts)) +
+                '\n').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients don't have an address
+        return str(self.client_address[0] if self.client_address
+                   else 'local')
+
+    def log_message(self, format, *args):
+        pass
 
 
-def opt_parse(argv):
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_dashboard_server(address, daemon):
+    """Listen on a unix socket path or a [host]:port"""
+    http_server = _import('http.server')
+    handler = type('DashboardHandler', (
+        DashboardHandler, http_server.BaseHTTPRequestHandler), {})
+    if _is_unix_address(address):
+        if os.path.exists(address):
+            os.unlink(address)
+        server = UnixHTTPServer(address, handler)
+    else:
+        host, _, port = address.rpartition(':')
+        server = http_server.ThreadingHTTPServer((host or '127.0.0.1',
+                                                  int(port)), handler)
+    server.daemon = daemon
+    return server
+
+
+def serve_dashboards(address, auth_creds, interval, zuul_tenant,
+                     zuul_strategy):
+    daemon = DashboardDaemon(auth_creds, interval, zuul_tenant,
+                             zuul_strategy)
+    server = make_dashboard_server(address, daemon)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def fetch_dashboard(address, opts):
+    """Ask a dash.py --serve daemon for a dashboard"""
+    http_client = _import('http.client')
+    path = '/dashboard?' + urlparse.urlencode(opts_to_params(opts))
+    if _is_unix_address(address):
+        conn = http_client.HTTPConnection('localhost', timeout=ZUUL_TIMEOUT)
+    else:
+        host, _, port = address.rpartition(':')
+        conn = http_client.HTTPConnection(host or '127.0.0.1', int(port),
+                                          timeout=ZUUL_TIMEOUT)
+    try:
+        if _is_unix_address(address):
+            # Connected already, so it doesn't try to reach localhost
+            conn.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.sock.settimeout(ZUUL_TIMEOUT)
+            conn.sock.connect(address)
+        conn.request('GET', path)
+        response = conn.getresponse()
+        body = response.read().decode('utf-8')
+        if response.status != 200:
+            raise Exception('%i %s' % (response.status, response.reason))
+        return body
+    finally:
+        conn.close()
+
+
+def connect_dashboard(address, opts):
+    while True:
+        try:
+            try:
+                body = fetch_dashboard(address, opts)
+            except Exception as e:
+                error('Failed to get dashboard from %s: %s' % (address, e))
+            else:
+                if opts.refresh:
+                    _reset_terminal()
+                print(body, end='')
+            if not opts.refresh:
+                break
+            time.sleep(opts.refresh)
+        except KeyboardInterrupt:
+            break
+
+
+# The options that make up a profile in dash.conf
+PROFILE_OPTS = ('owner', 'change', 'projects', 'topic', 'query', 'watched',
+                'starred', 'operator', 'jenkins', 'ignore_queue')
+
+
+def make_oslo_opt(cfg, action):
+    if action.nargs == 0 and isinstance(action.const, bool):
+        return cfg.BoolOpt(action.dest, default=action.default,
+                           help=action.help)
+    elif isinstance(action, argparse._AppendAction):
+        return cfg.ListOpt(action.dest, default=action.default,
+                           help=action.help)
+    elif action.type is int:
+        return cfg.IntOpt(action.dest, default=action.default,
+                          help=action.help)
+    elif action.type is float:
+        return cfg.FloatOpt(action.dest, default=action.default,
+                            help=action.help)
+    else:
+        return cfg.StrOpt(action.dest, default=action.default,
+                          help=action.help)
+
+
+def config_file():
+    return os.environ.get('DASH_CONFIG_FILE', 'dash.conf')
+
+
+def osloconfig_parse(parser, args, cfg):
+    """Fill in options from dash.conf that weren't given on the command line
+
+    dash.conf can also define profiles, each a set of filters to show as a
+    section of one screen::
+
+        [DEFAULT]
+        profiles = mine,nova
+
+        [profile:mine]
+        owner = me
+
+        [profile:nova]
+        projects = openstack/nova
+    """
+    args.profiles = []
+    path = config_file()
+    if not os.path.exists(path):
+        return args
+
+    actions = dict((action.dest, action) for action in parser._actions
+                   if action.option_strings and action.dest != 'help')
+    conf = cfg.ConfigOpts()
+    conf.register_opts([make_oslo_opt(cfg, action)
+                        for action in actions.values()])
+    conf.register_opt(cfg.ListOpt('profiles', default=[],
+                                  help='Profiles to show'))
+    conf([], project='dash', default_config_files=[path])
+
+    # Filters on the command line mean we're not showing the profiles
+    cli_filters = any(getattr(args, dest) != actions[dest].default
+                      for dest in PROFILE_OPTS)
+    # The command line wins over the config file
+    for dest, action in actions.items():
+        if getattr(args, dest) == action.default:
+            setattr(args, dest, conf[dest])
+
+    names = args.profile or ([] if cli_filters else conf.profiles)
+    for name in names:
+        group = 'profile:%s' % name
+        conf.register_opts([make_oslo_opt(cfg, actions[dest])
+                            for dest in PROFILE_OPTS], group=group)
+        profile = argparse.Namespace(name=name, user=args.user)
+        for dest in PROFILE_OPTS:
+            setattr(profile, dest, conf[group][dest])
+        args.profiles.append(profile)
+    return args
+
+
+def make_parser():
     usage = 'Usage: %s [options] [<username or review ID>]'
     argparser = argparse.ArgumentParser(usage=usage)
     argparser.add_argument('-u', '--user', help='Gerrit username',
@@ -474,6 +2401,12 @@ def opt_parse(argv):
                            default=os.environ.get('PASS'))
     argparser.add_argument('-r', '--refresh', help='Refresh in seconds',
                            default=0, type=int)
+    argparser.add_argument('--adaptive', action='store_true', default=False,
+                           help='Refresh less often while nothing changes '
+                                'and more often while jobs are running')
+    argparser.add_argument('--max-refresh', default=None, type=int,
+                           help='Never wait longer than this many seconds '
+                                'between refreshes')
     argparser.add_argument('-o', '--owner', default=None,
                            help='Show patches from this owner')
     argparser.add_argument('-c', '--change', default=None, action='append',
@@ -504,27 +2437,116 @@ def opt_parse(argv):
                            action='store_true', default=False)
     argparser.add_argument('-Q', '--ignore-queue', help='Ignore this queue',
                            action='append', default=[])
-    argparser.add_argument('username_or_review', help='username or review ID')
-    return argparser.parse_args()
+    argparser.add_argument('--stream-zuul', action='store_true',
+                           default=False,
+                           help='Parse the zuul status incrementally and only '
+                                'keep the parts for the changes shown '
+                                '(faster with the ijson module installed)')
+    argparser.add_argument('--resync', default=GERRIT_RESYNC, type=int,
+                           help='When refreshing, only ask gerrit for '
+                                'updated changes and do a full query every '
+                                'this many seconds')
+    argparser.add_argument('--diff-render', action='store_true',
+                           default=False,
+                           help='When refreshing, only redraw the lines that '
+                                'changed and page through changes that '
+                                'don\'t fit on the screen')
+    argparser.add_argument('--zuul-strategy', default='auto',
+                           choices=ZUUL_STRATEGIES,
+                           help='How to get zuul data: per watched change, '
+                                'for the whole tenant or the global status. '
+                                'The default picks the cheapest one.')
+    argparser.add_argument('--zuul-tenant', default=ZUUL_TENANT,
+                           help='Zuul tenant the changes are tested in')
+    argparser.add_argument('--gerrit-cache-ttl', default=GERRIT_CACHE_TTL,
+                           type=int,
+                           help='Without --refresh, reuse gerrit results '
+                                'for the same query from the last this many '
+                                'seconds. Off (0) by default.')
+    argparser.add_argument('--gerrit-cache-swr', default=0, type=int,
+                           help='Show cached gerrit results up to this many '
+                                'seconds past --gerrit-cache-ttl, while '
+                                'fetching fresh ones for next time')
+    argparser.add_argument('--gerrit-cache-size', default=GERRIT_CACHE_SIZE,
+                           type=int,
+                           help='Megabytes of gerrit results to keep in %s'
+                                % os.path.join(CACHE_DIR, 'gerrit'))
+    argparser.add_argument('--no-cache', action='store_true', default=False,
+                           help='Always ask gerrit, ignoring the gerrit '
+                                'cache')
+    argparser.add_argument('--gerrit-url', default=GERRIT_URL,
+                           help='Gerrit to ask for changes (also '
+                                '$DASH_GERRIT_URL)')
+    argparser.add_argument('--zuul-url', default=ZUUL_URL,
+                           help='Zuul to ask for the status of changes '
+                                '(also $DASH_ZUUL_URL)')
+    argparser.add_argument('--zuul-pool-size', default=ZUUL_POOL_SIZE,
+                           type=int,
+                           help='Connections to keep open to each zuul '
+                                'host between refreshes')
+    argparser.add_argument('--zuul-cache-ttl', default=0, type=int,
+                           help='Reuse the zuul status saved in %s if it '
+                                'is newer than this many seconds' % CACHE_DIR)
+    argparser.add_argument('--serve', metavar='ADDRESS', default=None,
+                           help='Run a daemon serving dashboards on this '
+                                'unix socket path or [host]:port. Zuul and '
+                                'gerrit are polled every --refresh seconds, '
+                                'as --user, so --query, --watched and '
+                                '--starred are not available to clients.')
+    argparser.add_argument('--connect', metavar='ADDRESS', default=None,
+                           help='Get the dashboard from a dash.py --serve '
+                                'daemon instead of zuul and gerrit')
+    argparser.add_argument('--profile', action='append', default=[],
+                           help='Show this profile from dash.conf. Can be '
+                                'specified multiple times; the default is '
+                                'all the profiles listed there.')
+    argparser.add_argument('--timings', action='store_true', default=False,
+                           help='Show how long each stage of a refresh took '
+                                'and how much data it handled')
+    argparser.add_argument('--metrics-file', metavar='PATH', default=None,
+                           help='After each refresh, write the stage '
+                                'timings here in prometheus text format')
+    argparser.add_argument('--cprofile', metavar='N', default=0, type=int,
+                           help='Profile the first N refreshes and print '
+                                'the stats to stderr')
+    argparser.add_argument('--cprofile-output', metavar='FILE', default=None,
+                           help='Also save the --cprofile stats here')
+    argparser.add_argument('--record', metavar='DIR', default=None,
+                           help='Save what gerrit and zuul return on every '
+                                'refresh to an archive in DIR')
+    argparser.add_argument('--replay', metavar='DIR', default=None,
+                           help='Show the refreshes saved with --record '
+                                'instead of asking gerrit and zuul')
+    argparser.add_argument('--replay-speed', default=1.0, type=float,
+                           help='Replay this many times faster than it was '
+                                'recorded (0 for as fast as possible)')
+    argparser.add_argument('username_or_review', nargs='?',
+                           help='username or review ID')
+    return argparser
+
+
+def opt_parse(argv):
+    return make_parser().parse_args(argv[1:])
 
 
 def parse_args(argv):
-    args = opt_parse(argv)
+    parser = make_parser()
+    args = parser.parse_args(argv[1:])
+    args.profiles = []
+    if not os.path.exists(config_file()):
+        # Don't pay for importing oslo.config for nothing
+        return args
     try:
-        from oslo.config import cfg
-        return osloconfig_parse(args, cfg)
+        cfg = _import('oslo_config.cfg')
     except ImportError:
-        return args
-
-
-def main():
-    opts = parse_args(sys.argv)
-    if opts.dump_zuul:
-        dump_zuul()
-        return
+        try:
+            cfg = _import('oslo.config.cfg')
+        except ImportError:
+            return args
+    return osloconfig_parse(parser, args, cfg)
 
-    auth_creds = (opts.user, opts.passwd)
 
+def make_filters(opts):
     filters = {}
     for filter_key in ['owner', 'change', 'topic']:
         value = getattr(opts, filter_key)
@@ -544,26 +2566,163 @@ def main():
     # Default case
     if not filters and not projects and not opts.query:
         filters = {'owner': opts.user}
+    return filters, projects
 
-    if opts.dump_gerrit:
-        dump_gerrit(auth_creds, filters, opts.operator, projects, opts.query)
-        return
 
+def query_operator(filters, operator):
     # If there are multiple changes, we have to use the OR operator.
-    operator = opts.operator
     if len(filters.get('change', [])) > 1:
-        operator = 'OR'
+        return 'OR'
+    return operator
+
+
+def make_gerrit_cache(opts):
+    # Refreshing already only asks gerrit for what changed
+    if opts.no_cache or opts.refresh or not opts.gerrit_cache_ttl:
+        return None
+    return GerritCache(opts.gerrit_cache_ttl, opts.gerrit_cache_swr,
+                       opts.gerrit_cache_size * 1024 * 1024)
+
+
+def run_cycle(func, *args, **kwargs):
+    if PROFILER is not None:
+        return PROFILER.run(func, *args, **kwargs)
+    return func(*args, **kwargs)
 
+
+def do_replay(opts, filters, operator, projects):
+    """Show what --record saw, as it saw it
+
+    Every recorded refresh goes through matching and rendering again, spaced
+    out like the original ones divided by --replay-speed (0 for no waiting).
+    """
+    renderer = DiffRenderer() if opts.diff_render else None
+    last = None
+    for record in replay_records(opts.replay):
+        try:
+            if last is not None and opts.replay_speed:
+                time.sleep(max(0, record['time'] - last) / opts.replay_speed)
+            last = record['time']
+            run_cycle(do_dashboard, None, opts.user, filters, True,
+                      opts.jenkins, operator, projects, opts.query,
+                      opts.ignore_queue, renderer=renderer,
+                      timings=opts.timings,
+                      snapshot=(record['gerrit'], record['zuul']))
+            if opts.metrics_file:
+                write_metrics(opts.metrics_file)
+        except KeyboardInterrupt:
+            break
+    if PROFILER is not None:
+        PROFILER.report()
+
+
+def do_profiles(opts, auth_creds):
+    gerrit_cache = make_gerrit_cache(opts)
+    renderer = scheduler = None
+    if opts.diff_render and opts.refresh:
+        renderer = DiffRenderer()
+    if opts.refresh:
+        scheduler = RefreshScheduler(opts.refresh, opts.adaptive,
+                                     opts.max_refresh)
     while True:
         try:
-            do_dashboard(auth_creds, opts.user, filters, opts.refresh != 0,
-                         opts.jenkins, operator, projects, opts.query,
-                         opts.ignore_queue)
+            run_cycle(do_profiles_dashboard, auth_creds, opts.user,
+                      opts.profiles, opts.refresh != 0, opts.stream_zuul,
+                      opts.zuul_cache_ttl, opts.refresh != 0, opts.resync,
+                      opts.zuul_strategy, opts.zuul_tenant, renderer,
+                      scheduler, opts.timings, gerrit_cache)
+            if opts.metrics_file:
+                write_metrics(opts.metrics_file)
             if not opts.refresh:
                 break
-            time.sleep(opts.refresh)
+            time.sleep(scheduler.interval)
+        except KeyboardInterrupt:
+            break
+    if PROFILER is not None:
+        PROFILER.report()
+
+
+def set_endpoints(gerrit_url, zuul_url):
+    global GERRIT_URL, ZUUL_URL, ZUUL_STATUS_URL
+    GERRIT_URL = gerrit_url.rstrip('/')
+    ZUUL_URL = zuul_url.rstrip('/')
+    ZUUL_STATUS_URL = ZUUL_URL + '/api/status'
+
+
+def main():
+    global PROFILER, zuul_session
+    opts = parse_args(sys.argv)
+    set_endpoints(opts.gerrit_url, opts.zuul_url)
+    if opts.zuul_pool_size != ZUUL_POOL_SIZE:
+        zuul_session = make_zuul_session(opts.zuul_pool_size)
+    if opts.cprofile:
+        PROFILER = CycleProfiler(opts.cprofile, opts.cprofile_output)
+    if opts.dump_zuul:
+        dump_zuul()
+        return
+
+    auth_creds = (opts.user, opts.passwd)
+
+    if opts.serve:
+        serve_dashboards(opts.serve, auth_creds, opts.refresh or 30,
+                         opts.zuul_tenant,
+                         'global' if opts.zuul_strategy == 'global'
+                         else 'tenant')
+        return
+    if opts.connect:
+        for name in DAEMON_REFUSED_OPTS:
+            if getattr(opts, name):
+                error('--%s is not supported with --connect' % name)
+                sys.exit(1)
+        connect_dashboard(opts.connect, opts)
+        return
+
+    if opts.profiles and not opts.dump_gerrit:
+        do_profiles(opts, auth_creds)
+        return
+
+    filters, projects = make_filters(opts)
+
+    gerrit_cache = make_gerrit_cache(opts)
+    if opts.dump_gerrit:
+        dump_gerrit(auth_creds, filters, opts.operator, projects, opts.query,
+                    gerrit_cache)
+        return
+
+    operator = query_operator(filters, opts.operator)
+    if opts.replay:
+        do_replay(opts, filters, operator, projects)
+        return
+
+    zuul_strategy = choose_zuul_strategy(filters, projects, opts.query,
+                                         opts.zuul_strategy)
+    renderer = scheduler = None
+    if opts.diff_render and opts.refresh:
+        renderer = DiffRenderer()
+    if opts.refresh:
+        scheduler = RefreshScheduler(opts.refresh, opts.adaptive,
+                                     opts.max_refresh)
+    recorder = Recorder(opts.record) if opts.record else None
+    while True:
+        try:
+            run_cycle(do_dashboard, auth_creds, opts.user, filters,
+                      opts.refresh != 0, opts.jenkins, operator, projects,
+                      opts.query, opts.ignore_queue, opts.stream_zuul,
+                      opts.zuul_cache_ttl, opts.refresh != 0, opts.resync,
+                      zuul_strategy, opts.zuul_tenant, renderer, scheduler,
+                      opts.timings, gerrit_cache, recorder)
+            if opts.metrics_file:
+                write_metrics(opts.metrics_file)
+            if not opts.refresh:
+                break
+            time.sleep(scheduler.interval)
         except KeyboardInterrupt:
             break
+    if recorder is not None:
+        recorder.close()
+    if PROFILER is not None:
+        # In case we stopped before getting through all the cycles
+        PROFILER.report()
 
 
 if __name__ == '__main__':
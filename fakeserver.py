@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# fakeserver - a local stand-in for gerrit and zuul
+#
+# This serves the bits of the gerrit and zuul APIs that dash.py uses, with
+# data from bench.py's generators, so that dash.py can be load tested
+# without going anywhere near the real thing. Responses can be made slow,
+# flaky or trickle out a few bytes at a time. Point dash.py at it with:
+#
+#   ./fakeserver.py --port 8080 &
+#   ./dash.py --gerrit-url http://localhost:8080 \
+#       --zuul-url http://localhost:8080 -q status:open
+
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+from http import server as http_server
+from urllib import parse as urlparse
+
+import bench
+
+GERRIT_PREFIX = b")]}'\n"
+# Gerrit won't return more than this many changes per page, however many
+# are asked for
+GERRIT_PAGE_CAP = 500
+CHANGE_PATH = re.compile(r'^/api/tenant/[^/]+/status/change/(\d+),(\d+)$')
+STATUS_PATH = re.compile(r'^/api(/tenant/[^/]+)?/status$')
+ACCOUNT_PATH = re.compile(r'^/a/accounts/([^/]+)$')
+CHANGE_TERM = re.compile(r'\bchange:(\d+)')
+
+
+class Backend(object):
+    """The data being served, and how badly to serve it"""
+
+    def __init__(self, seed=0, pipelines=2, queue_depth=1000, jobs=30,
+                 watched=100, page_cap=GERRIT_PAGE_CAP, latency=0.0,
+                 jitter=0.0, error_rate=0.0, drip_rate=0, drip_chunk=1024,
+                 regenerate=0):
+        self.params = (pipelines, queue_depth, jobs, watched)
+        self.page_cap = page_cap
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drip_rate = drip_rate
+        self.drip_chunk = drip_chunk
+        self.regenerate = regenerate
+        self.requests = 0
+        self._rand = random.Random(seed)
+        self._lock = threading.Lock()
+        self._generate(seed)
+
+    def _generate(self, seed):
+        pipelines, queue_depth, jobs, watched = self.params
+        zuul_data = bench.make_zuul_status(seed, pipelines, queue_depth, jobs)
+        changes = bench.make_gerrit_changes(zuul_data, seed, watched)
+        items = {}
+        for pipeline in zuul_data['pipelines']:
+            for queue in pipeline['change_queues']:
+                for head in queue['heads']:
+                    for item in head:
+                        items.setdefault(item['id'], []).append(item)
+        status = json.dumps(zuul_data).encode()
+        with self._lock:
+            self.generated = time.time()
+            self.seed = seed
+            self.changes = changes
+            self.items = dict((key, json.dumps(value).encode())
+                              for key, value in items.items())
+            self.status = status
+            self.status_gz = gzip.compress(status)
+            self.etag = '"%s"' % hashlib.sha1(status).hexdigest()[:16]
+
+    def maybe_regenerate(self):
+        """Move on to a new status every regenerate seconds"""
+        with self._lock:
+            if (not self.regenerate or
+                    time.time() - self.generated <= self.regenerate):
+                return
+            # Only one request does the work, the rest get the old status
+            self.generated = time.time()
+        self._generate(self.seed + 1)
+
+    def zuul_status(self):
+        with self._lock:
+            return self.status, self.status_gz, self.etag, self.items
+
+    def gerrit_page(self, start, limit, options=(), numbers=None):
+        """A page of changes with only the fields options ask for"""
+        with self._lock:
+            changes = self.changes
+        if numbers:
+            # Just the change:N terms of the query
+            changes = [change for change in changes
+                       if str(change['_number']) in numbers]
+        limit = min(limit, self.page_cap)
+        page = [project_change(change, options)
+                for change in changes[start:start + limit]]
+        if page and start + limit < len(changes):
+            page[-1]['_more_changes'] = True
+        return GERRIT_PREFIX + json.dumps(page).encode()
+
+    def account(self, username):
+        with self._lock:
+            changes = self.changes
+        for change in changes:
+            if change['owner']['username'] == username:
+                return GERRIT_PREFIX + json.dumps(change['owner']).encode()
+        return None
+
+    def delay(self):
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._rand.uniform(0, self.jitter)
+            fail = self._rand.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        return fail
+
+
+def project_change(change, options):
+    change = dict(change)
+    if 'DETAILED_ACCOUNTS' not in options:
+        change['owner'] = {'_account_id': change['owner']['_account_id']}
+    if 'DETAILED_LABELS' not in options:
+        change.pop('labels', None)
+    if 'CURRENT_REVISION' not in options:
+        change.pop('current_revision', None)
+        change.pop('revisions', None)
+    change.pop('patchset', None)
+    return change
+
+
+class FakeHandler(http_server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        backend = self.server.backend
+        if backend.delay():
+            self.send_body(b'Injected failure\n', status=503)
+            return
+        backend.maybe_regenerate()
+        url = urlparse.urlsplit(self.path)
+        if url.path in ('/a/changes/', '/changes/'):
+            params = urlparse.parse_qs(url.query)
+            start = int(params.get('S', ['0'])[0])
+            limit = int(params.get('n', [str(backend.page_cap)])[0])
+            numbers = set(CHANGE_TERM.findall(params.get('q', [''])[0]))
+            self.send_body(backend.gerrit_page(start, limit,
+                                               params.get('o', []), numbers))
+            return
+        match = ACCOUNT_PATH.match(url.path)
+        if match:
+            body = backend.account(urlparse.unquote(match.group(1)))
+            if body is None:
+                self.send_body(b'Not found\n', status=404)
+            else:
+                self.send_body(body)
+            return
+        status, status_gz, etag, items = backend.zuul_status()
+        match = CHANGE_PATH.match(url.path)
+        if match:
+            self.send_body(items.get('%s,%s' % match.groups(), b'[]'))
+            return
+        if STATUS_PATH.match(url.path):
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_body(status, status_gz, etag)
+            return
+        self.send_body(b'Not found\n', status=404)
+
+    def send_body(self, body, gzipped=None, etag=None, status=200):
+        headers = {'Content-Type': 'application/json'}
+        accept = self.headers.get('Accept-Encoding') or ''
+        if gzipped is not None and 'gzip' in accept:
+            body = gzipped
+            headers['Content-Encoding'] = 'gzip'
+        if etag:
+            headers['ETag'] = etag
+        headers['Content-Length'] = str(len(body))
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.drip(body)
+
+    def drip(self, body):
+        backend = self.server.backend
+        if not backend.drip_rate:
+            self.wfile.write(body)
+            return
+        # Trickle the body out at drip_rate bytes a second
+        chunk = backend.drip_chunk
+        for pos in range(0, len(body), chunk):
+            self.wfile.write(body[pos:pos + chunk])
+            self.wfile.flush()
+            time.sleep(float(chunk) / backend.drip_rate)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http_server.BaseHTTPRequestHandler.log_message(self, format,
+                                                           *args)
+
+
+def make_server(backend, host='127.0.0.1', port=0, verbose=False):
+    server = http_server.ThreadingHTTPServer((host, port), FakeHandler)
+    server.daemon_threads = True
+    server.backend = backend
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve fake gerrit and zuul APIs for dash.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pipelines', type=int, default=2,
+                        help='Number of zuul pipelines')
+    parser.add_argument('--queue-depth', type=int, default=1000,
+                        help='Items in each pipeline')
+    parser.add_argument('--jobs', type=int, default=30,
+                        help='Jobs per item')
+    parser.add_argument('--changes', type=int, default=100,
+                        help='Changes gerrit returns for any query')
+    parser.add_argument('--page-cap', type=int, default=GERRIT_PAGE_CAP,
+                        help='Most changes gerrit returns per page')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to wait before every response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Up to this many more seconds of random wait')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests that get a 503')
+    parser.add_argument('--drip-rate', type=int, default=0,
+                        help='Send bodies at this many bytes per second')
+    parser.add_argument('--drip-chunk', type=int, default=1024,
+                        help='Bytes per write when dripping')
+    parser.add_argument('--regenerate', type=float, default=0,
+                        help='Serve a new zuul status every this many '
+                             'seconds')
+    parser.add_argument('--verbose', action='store_true', default=False,
+                        help='Log every request')
+    args = parser.parse_args()
+
+    backend = Backend(args.seed, args.pipelines, args.queue_depth, args.jobs,
+                      args.changes, args.page_cap, args.latency, args.jitter,
+                      args.error_rate, args.drip_rate, args.drip_chunk,
+                      args.regenerate)
+    server = make_server(backend, args.host, args.port, args.verbose)
+    print('Serving %i changes and a %.1f MB zuul status (%.1f MB gzipped) '
+          'on http://%s:%i' % (len(backend.changes),
+                               len(backend.status) / 1048576.0,
+                               len(backend.status_gz) / 1048576.0,
+                               args.host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('Served %i requests' % backend.requests)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,51 +7,102 @@
 # Unlike the regular finger, it handles dropped connections and tries to
 # resume to the same point in the stream to avoid having to redisplay the
 # progress each time.
+#
+# Several builds can be watched at once, each one named like JOB=BUILD or
+# just BUILD, in which case lines are prefixed with the job name (or the
+# start of the build UUID) so they can be told apart.
+#
+# Everything streamed is kept in a compressed spool under ~/.cache/osfinger
+# so that watching the same build again starts from there, and so that
+# --grep and --tail can look through a finished build without streaming it
+# again.
+#
+# Without lnav, --include, --exclude and --context pick out the lines worth
+# watching, and errors and warnings are highlighted on a terminal.
 
 import argparse
 import asyncio
+import codecs
+import collections
+import json
 import logging
+import mmap
+import os
+import re
+import stat
 import subprocess
 import sys
-import unittest
-from unittest import mock
+import time
 import urllib.parse
+import zlib
 
 LOG = logging.getLogger('osfinger')
-BUFFER_LIMIT = 1024
+BUILD_NOT_FOUND = b'Build not found'
+FINGER_HOST = 'zuul.opendev.org'
+FINGER_PORT = 79
+# How many builds to stream at the same time, the rest wait their turn.
+# Each one can hold a connection and two spool files open, so this stays
+# within the usual limit of 1024 open files.
+MAX_STREAMS = 250
+RECONNECT_DELAY = 1
+# Give up on a build after failing to connect this many times in a row,
+# rather than keep its place from the builds waiting for one
+CONNECT_ATTEMPTS = 10
+# Output is written out once this much has piled up, or this long after
+# the first of it arrived, whichever is sooner
+FLUSH_SIZE = 64 * 1024
+FLUSH_INTERVAL = 0.05
+# Stop reading from zuul while this much is waiting to go down the pipe
+HIGH_WATER = 1024 * 1024
+SPOOL_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'osfinger')
+# Megabytes of spools to keep, least recently used go first
+SPOOL_SIZE = 500
+# Spools are made of independently compressed blocks of whole lines of
+# about this size, so any part can be read without the rest. Consoles
+# compress well even at the fastest level, which keeps up with streaming.
+SPOOL_BLOCK = 256 * 1024
+SPOOL_LEVEL = 1
+# Which blocks have these in them is indexed, so searching for them can
+# skip the rest
+KEYWORDS = ('ERROR', 'Traceback', 'FAILED', 'WARNING', 'CRITICAL',
+            'Timeout')
+# Lines with these in are highlighted, by whichever comes first
+SEVERITIES = (
+    ('critical', r'CRITICAL|Traceback', '\033[1;31m'),
+    ('error', r'ERROR|FAILED|FAILURE', '\033[31m'),
+    ('warning', r'WARNING', '\033[33m'),
+)
+SEVERITY_RE = re.compile('|'.join('(?P<%s>%s)' % (name, pattern)
+                                  for name, pattern, _ in SEVERITIES))
+SEVERITY_COLORS = dict((name, color) for name, _, color in SEVERITIES)
+# They are all plain words, and looking for those is much quicker
+SEVERITY_WORDS = [word for _, pattern, _ in SEVERITIES
+                  for word in pattern.split('|')]
+RESET_COLOR = '\033[0m'
 
 
 class FingerProtocol(asyncio.Protocol):
-    def __init__(self, build, end_future, position):
+    def __init__(self, build, end_future, position, write=None, flow=None,
+                 spool=None):
         self._build = build
-        self._chars = 0
+        self._bytes = 0
         self._end_future = end_future
         self._startpos = position
-        self._buffer = b''
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self._write = write
+        self._flow = flow
+        self._spool = spool
         super().__init__()
 
     def connection_made(self, transport):
         LOG.debug('Connected - sending build %s' % self._build)
         self.transport = transport
+        if self._flow is not None:
+            self._flow.add_reader(transport)
         transport.write(self._build.encode() + b'\r\n')
 
     def data_received(self, data):
-        try:
-            datastr = (self._buffer + data).decode()
-            self._buffer = b''
-        except UnicodeDecodeError:
-            # This can happen if we get a chunk of data that ends in the middle
-            # of a unicode character. Buffer this chunk (up to our limit) and
-            # use later to hopefully recover.
-            if len(self._buffer) < BUFFER_LIMIT:
-                self._buffer += data
-                LOG.debug('Buffering chunk to handle unicode')
-            else:
-                LOG.error('Failed to resolve decode error with buffer')
-                self._buffer = b''
-            return
-
-        if datastr == 'Build not found' and not self._chars:
+        if data == BUILD_NOT_FOUND and not self._bytes:
             # This is what tells us the build is done and we should stop
             # reconnecting. Set the condition to True (finished) and make sure
             # we don't overwrite it in our connection_lost() handler.
@@ -60,30 +111,699 @@ class FingerProtocol(asyncio.Protocol):
             self._end_future = None
             self.transport.close()
             return
-        prevpos = self._chars
-        self._chars += len(datastr)
-        if self._chars < self._startpos:
-            # Catching up to our previous position - discard
+        prevpos = self._bytes
+        self._bytes += len(data)
+        if self._bytes <= self._startpos:
+            # Catching up to our previous position - discard without even
+            # decoding it
             LOG.debug('Skipping %i to position %s',
-                      self._chars, self._startpos)
+                      self._bytes, self._startpos)
             return
-        elif prevpos < self._startpos < self._chars:
+        elif prevpos < self._startpos:
             # This straddles the old threshold, grab anything new
-            chunkpos = self._chars - self._startpos
-            datastr = datastr[chunkpos - 1:]
+            data = data[self._startpos - prevpos:]
             LOG.debug('Truncated %i initial bytes of partial message %i/%i',
-                      chunkpos, self._startpos, self._chars)
-        sys.stdout.write(datastr)
+                      self._startpos - prevpos, self._startpos, self._bytes)
+        if self._spool is not None:
+            self._spool.write(data)
+        # The decoder holds on to the start of a character split across
+        # chunks until the rest arrives
+        datastr = self._decoder.decode(data)
+        if datastr:
+            # Not bound at creation time, so that sys.stdout can be replaced
+            (self._write or sys.stdout.write)(datastr)
 
     def connection_lost(self, exc):
+        if self._flow is not None:
+            self._flow.remove_reader(self.transport)
         if self._end_future:
             LOG.debug('Connection lost unexpectedly')
             self._end_future.set_result(self.position)
 
     @property
     def position(self):
-        """The position (in characters) in the stream so far"""
-        return self._chars
+        """The position (in bytes) in the stream written out so far
+
+        Bytes of a partly received character don't count, so a resume
+        starts with the whole of it. Dropping out while still catching up
+        doesn't lose the place we had already got to.
+        """
+        if self._bytes <= self._startpos:
+            return self._startpos
+        return self._bytes - len(self._decoder.getstate()[0])
+
+
+def _is_stderr(info):
+    """Whether the file os.fstat() gave info for is also stderr"""
+    try:
+        return os.path.samestat(info, os.fstat(2))
+    except OSError:
+        return False
+
+
+class OutputStage(asyncio.Protocol):
+    """Coalesce everything we show into fewer, bigger writes
+
+    Writes are held until FLUSH_SIZE has piled up or FLUSH_INTERVAL has
+    passed. Once connect()ed to a pipe, they go down it without blocking
+    the event loop; if the other end (lnav, say) falls HIGH_WATER behind,
+    reading from the finger connections is paused until it catches up.
+    Anything else is written to synchronously.
+    """
+
+    def __init__(self, write=None, flush_size=FLUSH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, high_water=HIGH_WATER):
+        self._write = write
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._high_water = high_water
+        self._loop = asyncio.get_running_loop()
+        self._chunks = []
+        self._size = 0
+        self._timer = None
+        self._pipe = None
+        self._fd = None
+        self._transport = None
+        self._readers = set()
+        self._paused = False
+        self._drained = None
+        self.closed = self._loop.create_future()
+        self.bytes = 0
+        self.writes = 0
+        self.pauses = 0
+        self._started = time.monotonic()
+
+    async def connect(self, pipe):
+        """Send output to the binary file object pipe"""
+        self._pipe = pipe
+        try:
+            info = os.fstat(pipe.fileno())
+            if not stat.S_ISFIFO(info.st_mode):
+                # Making a tty non-blocking would affect stderr too
+                raise ValueError('not a pipe')
+            if _is_stderr(info):
+                # As would 2>&1, which shares the pipe with stderr
+                raise ValueError('stderr goes down the same pipe')
+            self._fd = pipe.fileno()
+            # Our own copy, so closing it leaves pipe alone. It still shares
+            # the O_NONBLOCK flag, which close() puts back.
+            pipe = os.fdopen(os.dup(pipe.fileno()), 'wb', buffering=0)
+            await self._loop.connect_write_pipe(lambda: self, pipe)
+        except (AttributeError, NotImplementedError, OSError,
+                ValueError) as e:
+            LOG.debug('Writing output synchronously: %s', e)
+
+    def connection_made(self, transport):
+        self._transport = transport
+        transport.set_write_buffer_limits(high=self._high_water)
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            LOG.info('Output closed: %s', exc)
+        self._resume_readers()
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def pause_writing(self):
+        LOG.debug('Output is behind, pausing %i streams',
+                  len(self._readers))
+        self._paused = True
+        self.pauses += 1
+        for transport in self._readers:
+            transport.pause_reading()
+
+    def resume_writing(self):
+        LOG.debug('Output caught up, resuming streams')
+        self._resume_readers()
+
+    def _resume_readers(self):
+        self._paused = False
+        for transport in self._readers:
+            if not transport.is_closing():
+                transport.resume_reading()
+        if self._drained is not None and not self._drained.done():
+            self._drained.set_result(None)
+
+    async def drain(self):
+        """Wait until the pipe has caught up, for output not from zuul"""
+        if self._paused:
+            if self._drained is None or self._drained.done():
+                self._drained = self._loop.create_future()
+            await self._drained
+
+    def add_reader(self, transport):
+        self._readers.add(transport)
+        if self._paused:
+            transport.pause_reading()
+
+    def remove_reader(self, transport):
+        self._readers.discard(transport)
+
+    def write(self, text):
+        self._chunks.append(text)
+        self._size += len(text)
+        if self._size >= self._flush_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self._flush_interval,
+                                                self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._chunks:
+            return
+        text = ''.join(self._chunks)
+        self._chunks = []
+        self._size = 0
+        self.writes += 1
+        if self._transport is not None:
+            data = text.encode()
+            self.bytes += len(data)
+            if not self.closed.done():
+                self._transport.write(data)
+        elif self._pipe is not None:
+            data = text.encode()
+            self.bytes += len(data)
+            self._pipe.write(data)
+            self._pipe.flush()
+        else:
+            self.bytes += len(text)
+            (self._write or sys.stdout.write)(text)
+
+    async def close(self):
+        """Write out anything left and wait for it to get there"""
+        self.flush()
+        if self._transport is not None and not self.closed.done():
+            self._transport.close()
+            await self.closed
+        if self._fd is not None:
+            try:
+                os.set_blocking(self._fd, True)
+            except OSError:
+                pass
+            self._fd = None
+
+    def report(self):
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        LOG.info('Wrote %.1f MB in %i writes (%.2f MB/s), paused reading '
+                 '%i times', self.bytes / 1048576.0, self.writes,
+                 self.bytes / 1048576.0 / elapsed, self.pauses)
+
+
+class LinePrefixer(object):
+    """Write only whole lines, each starting with prefix
+
+    Chunks from the network don't end on line boundaries, so the end of
+    each one is held back until the rest of its line arrives.
+    """
+
+    def __init__(self, prefix, write=None):
+        self._prefix = prefix
+        self._write = write
+        self._partial = ''
+
+    def __call__(self, text):
+        lines = text.split('\n')
+        lines[0] = self._partial + lines[0]
+        self._partial = lines.pop()
+        if lines:
+            (self._write or sys.stdout.write)(''.join(
+                '%s%s\n' % (self._prefix, line) for line in lines))
+
+    def flush(self):
+        if self._partial:
+            partial, self._partial = self._partial, ''
+            self(partial + '\n')
+
+
+def combine_patterns(patterns):
+    """One compiled regex that matches where any of patterns do
+
+    It is multiline so that ^ and $ still match at each line when it is
+    run over a whole chunk of them at once.
+    """
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % pattern for pattern in patterns),
+                      re.MULTILINE)
+
+
+class LineFilter(object):
+    """Write only the lines that match include and not exclude
+
+    Like grep, context lines either side of a match are shown too, with
+    -- between groups that aren't next to each other, and lines can be
+    highlighted by severity. Only whole lines are written; the end of a
+    chunk is held back until the rest of its line arrives. Each chunk is
+    searched as a whole first, so the (usual) chunks with nothing of
+    interest in them cost one regex search.
+    """
+
+    def __init__(self, include=(), exclude=(), context=0, highlight=False,
+                 write=None):
+        self._include = combine_patterns(include)
+        self._exclude = combine_patterns(exclude)
+        self._context = context
+        self._highlight = highlight
+        self._write = write
+        self._partial = ''
+        self._before = collections.deque(maxlen=context)
+        self._after = 0
+        self._skipped = False
+        self._shown = False
+
+    def __call__(self, text):
+        cut = text.rfind('\n') + 1
+        if not cut:
+            self._partial += text
+            return
+        text, self._partial = self._partial + text[:cut], text[cut:]
+        text = self._filter(text)
+        if text:
+            (self._write or sys.stdout.write)(text)
+
+    def flush(self):
+        if self._partial:
+            partial, self._partial = self._partial, ''
+            self(partial + '\n')
+        flush = getattr(self._write, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def _filter(self, text):
+        """Return what to show of text, which is whole lines"""
+        if self._include is None and self._exclude is None:
+            return self._color(text)
+        if (self._include is not None and not self._after and
+                not self._include.search(text)):
+            self._skip(text)
+            return ''
+        shown = []
+        for line in text.splitlines(True):
+            if self._exclude is not None and self._exclude.search(line):
+                continue
+            if self._include is None or self._include.search(line):
+                if self._skipped and self._shown and self._context:
+                    shown.append('--\n')
+                shown.extend(self._before)
+                self._before.clear()
+                shown.append(line)
+                self._after = self._context
+                self._skipped = False
+                self._shown = True
+            elif self._after:
+                shown.append(line)
+                self._after -= 1
+            elif self._context:
+                if len(self._before) == self._context:
+                    self._skipped = True
+                self._before.append(line)
+            else:
+                self._skipped = True
+        return self._color(''.join(shown))
+
+    def _skip(self, text):
+        """Lines with no matches, just keep the last few for context"""
+        if not self._context:
+            self._skipped = True
+            return
+        # Enough lines from the end (that aren't excluded) to tell if any
+        # more than the context will drop out
+        lines = []
+        end = len(text) - 1
+        while end >= 0 and len(lines) <= self._context:
+            start = text.rfind('\n', 0, end) + 1
+            line = text[start:end + 1]
+            if self._exclude is None or not self._exclude.search(line):
+                lines.append(line)
+            end = start - 1
+        if len(self._before) + len(lines) > self._context:
+            self._skipped = True
+        self._before.extend(reversed(lines))
+
+    def _color(self, text):
+        if not self._highlight or not any(word in text
+                                          for word in SEVERITY_WORDS):
+            return text
+        parts = []
+        pos = 0
+        for match in SEVERITY_RE.finditer(text):
+            if match.start() < pos:
+                # Already did this line
+                continue
+            start = text.rfind('\n', 0, match.start()) + 1
+            end = text.find('\n', match.end())
+            if end < 0:
+                end = len(text)
+            parts.append(text[pos:start])
+            parts.append(SEVERITY_COLORS[match.lastgroup] +
+                         text[start:end] + RESET_COLOR)
+            pos = end
+        parts.append(text[pos:])
+        return ''.join(parts)
+
+
+class Spool(object):
+    """A compressed copy of a build's console, and an index of it
+
+    The spool file is a series of independent zlib blocks of whole lines.
+    Next to it, one JSON line per block records where the block is, where
+    it starts in the stream, how many lines it has and which KEYWORDS are
+    in it, and a last line marks the end of the build. Both files are only
+    ever appended to.
+    """
+
+    def __init__(self, directory, build):
+        name = re.sub(r'[^\w-]', '_', build)
+        self.path = os.path.join(directory, name + '.spool')
+        self.index_path = os.path.join(directory, name + '.index')
+        self.blocks = []
+        self.ended = False
+        self._pending = b''
+        self._file = None
+        self._index_size = 0
+        self._load()
+
+    def _load(self):
+        try:
+            size = os.path.getsize(self.path)
+            with open(self.index_path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Cut short, the block didn't make it either
+                        break
+                    if entry.get('end'):
+                        self.ended = True
+                    elif entry['pos'] + entry['size'] <= size:
+                        self.blocks.append(entry)
+                    else:
+                        break
+                    self._index_size += len(line)
+        except OSError:
+            self.blocks = []
+            self._index_size = 0
+
+    @property
+    def length(self):
+        """How many bytes of the stream are spooled"""
+        return self.spooled + len(self._pending)
+
+    @property
+    def spooled(self):
+        if not self.blocks:
+            return 0
+        return self.blocks[-1]['offset'] + self.blocks[-1]['length']
+
+    @property
+    def lines(self):
+        if not self.blocks:
+            return 0
+        return self.blocks[-1]['line'] + self.blocks[-1]['lines']
+
+    def write(self, data):
+        self._pending += data
+        while len(self._pending) >= SPOOL_BLOCK:
+            cut = self._pending.rfind(b'\n', 0, SPOOL_BLOCK) + 1
+            if not cut:
+                # No newline in sight, but don't split a character
+                cut = min(SPOOL_BLOCK, len(self._pending) - 1)
+                while cut and self._pending[cut] & 0xC0 == 0x80:
+                    cut -= 1
+                if not cut:
+                    # Not text at all, so there is nothing to keep whole
+                    cut = SPOOL_BLOCK
+            self._add_block(self._pending[:cut])
+            self._pending = self._pending[cut:]
+
+    def rewind(self, length):
+        """Forget what came after length bytes of the stream
+
+        Only what isn't written out yet can go, which is always enough for
+        the part of a character FingerProtocol holds back.
+        """
+        self._pending = self._pending[:max(0, length - self.spooled)]
+
+    def _open(self):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, 'ab')
+            self._index = open(self.index_path, 'a')
+            # Cut off anything after the last block we know about
+            self._file.truncate(self._end())
+            self._index.truncate(self._index_size)
+        return self._file
+
+    def _end(self):
+        if not self.blocks:
+            return 0
+        return self.blocks[-1]['pos'] + self.blocks[-1]['size']
+
+    def _add_block(self, data):
+        spool = self._open()
+        compressed = zlib.compress(data, SPOOL_LEVEL)
+        entry = {'offset': self.spooled, 'length': len(data),
+                 'pos': self._end(), 'size': len(compressed),
+                 'line': self.lines, 'lines': data.count(b'\n'),
+                 'keywords': [keyword for keyword in KEYWORDS
+                              if keyword.encode() in data]}
+        spool.write(compressed)
+        spool.flush()
+        self._index.write(json.dumps(entry) + '\n')
+        self._index.flush()
+        self.blocks.append(entry)
+
+    def close(self, ended=False):
+        if self._pending:
+            self._add_block(self._pending)
+            self._pending = b''
+        if ended and self.blocks and not self.ended:
+            self._open()
+            self._index.write(json.dumps({'end': True}) + '\n')
+            self.ended = True
+        if self._file is not None:
+            self._file.close()
+            self._index.close()
+            self._file = None
+
+    def read(self, blocks=None):
+        """Yield the stream (or just blocks of it) a block at a time"""
+        if not self.blocks:
+            return
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as spool:
+                for block in self.blocks if blocks is None else blocks:
+                    yield zlib.decompress(
+                        spool[block['pos']:block['pos'] + block['size']])
+
+    def tail(self, count):
+        """The last count lines, only reading the blocks they are in"""
+        start = len(self.blocks)
+        lines = 0
+        while start and lines <= count:
+            start -= 1
+            lines += self.blocks[start]['lines']
+        data = b''.join(self.read(self.blocks[start:]))
+        return data.splitlines(True)[-count:] if count else []
+
+    def grep(self, pattern):
+        """Yield the lines matching a regex pattern
+
+        When pattern is just a keyword (or a literal with one in it), blocks
+        without that keyword are skipped without decompressing them.
+        """
+        regex = re.compile(pattern.encode())
+        blocks = self.blocks
+        if re.escape(pattern) == pattern:
+            keywords = [keyword for keyword in KEYWORDS if keyword in pattern]
+            if keywords:
+                blocks = [block for block in blocks
+                          if keywords[0] in block['keywords']]
+        for data in self.read(blocks):
+            if regex.search(data):
+                for line in data.splitlines(True):
+                    if regex.search(line):
+                        yield line
+
+
+def evict_spools(directory, size=SPOOL_SIZE, keep=()):
+    """Remove the least recently used spools until under size megabytes"""
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    spools = []
+    total = 0
+    for name in names:
+        if not name.endswith('.spool'):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        spools.append((st.st_mtime, path))
+        total += st.st_size
+    keep = [os.path.abspath(path) for path in keep]
+    for _, path in sorted(spools):
+        if total <= size * 1024 * 1024:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        total -= os.path.getsize(path)
+        LOG.debug('Evicting spool %s', path)
+        for victim in (path, path[:-len('.spool')] + '.index'):
+            try:
+                os.unlink(victim)
+            except OSError:
+                pass
+
+
+def show_spools(builds, pattern=None, count=None, spool_dir=SPOOL_DIR,
+                write=None):
+    """Show (some of) what was spooled for builds, without streaming
+
+    Returns False if any of them haven't been spooled.
+    """
+    found = True
+    for name, host, build in builds:
+        spool = Spool(spool_dir, build)
+        if not spool.blocks:
+            LOG.error('Nothing spooled for %s', build)
+            found = False
+            continue
+        # Recently used, as far as evict_spools() is concerned
+        os.utime(spool.path)
+        if pattern is not None:
+            lines = spool.grep(pattern)
+            if count is not None:
+                lines = collections.deque(lines, count)
+        else:
+            lines = spool.tail(count)
+        prefix = '%s| ' % name if len(builds) > 1 else ''
+        (write or sys.stdout.write)(''.join(
+            prefix + line.decode('utf-8', 'replace') for line in lines))
+    return found
+
+
+def parse_build(arg):
+    """Turn JOB=BUILD or BUILD into (name, host, build UUID)
+
+    BUILD is a stream URL or a build UUID. Without a job name, the first
+    few characters of the UUID will do.
+    """
+    name, sep, build = arg.partition('=')
+    if not sep or '/' in name:
+        # No job name, the = (if any) is part of a URL
+        name, build = '', arg
+    if build.startswith('http'):
+        url = urllib.parse.urlparse(build)
+        path = url.path.split('/')
+        build = path[path.index('stream') + 1]
+        host = url.hostname
+    else:
+        host = FINGER_HOST
+    return name or build[:7], host, build
+
+
+async def stream_build(host, build, limit, write=None, port=FINGER_PORT,
+                       flow=None, spool=None):
+    """Stream one build, reconnecting until we get an end-of-stream
+
+    What is already in the spool is shown from there, and streaming
+    picks up where it left off.
+    """
+    loop = asyncio.get_running_loop()
+    startpos = 0
+    ended = False
+    failures = 0
+    if spool is not None:
+        for data in spool.read():
+            write(data.decode('utf-8', 'replace'))
+            if flow is not None:
+                await flow.drain()
+        startpos = spool.length
+        ended = spool.ended
+    try:
+        async with limit:
+            while not ended:
+                if spool is not None:
+                    spool.rewind(startpos)
+                end = loop.create_future()
+                LOG.debug('Connecting to %s for %s...', host, build)
+                try:
+                    await loop.create_connection(
+                        lambda: FingerProtocol(build, end, startpos, write,
+                                               flow, spool),
+                        host, port)
+                except OSError as e:
+                    LOG.warning('Failed to connect for %s: %s', build, e)
+                    failures += 1
+                    if failures >= CONNECT_ATTEMPTS:
+                        LOG.error('Giving up on %s after %i attempts',
+                                  build, failures)
+                        break
+                    await asyncio.sleep(RECONNECT_DELAY)
+                    continue
+                failures = 0
+                position = await end
+                # None means end of stream, don't restart
+                ended = position is None
+                startpos = position or startpos
+    finally:
+        if spool is not None:
+            spool.close(ended)
+    if isinstance(write, (LinePrefixer, LineFilter)):
+        write.flush()
+
+
+async def stream_builds(builds, max_streams=MAX_STREAMS, write=None,
+                        port=FINGER_PORT, pipe=None, spool_dir=None,
+                        spool_size=SPOOL_SIZE, filters=None):
+    """Stream all of builds (from parse_build()) at once
+
+    With more than one build, each line is prefixed with the name of the
+    build it came from. Output goes to pipe if given, otherwise to write
+    (or stdout). Streams are spooled in spool_dir, if given, and filtered
+    by a LineFilter made with filters, if given.
+    """
+    output = OutputStage(write)
+    if pipe is not None:
+        await output.connect(pipe)
+    elif write is None and hasattr(sys.stdout, 'buffer'):
+        await output.connect(sys.stdout.buffer)
+    limit = asyncio.Semaphore(max_streams)
+    streams = []
+    spools = []
+    for name, host, build in builds:
+        stream_write = output.write
+        if len(builds) > 1:
+            stream_write = LinePrefixer('%s| ' % name, output.write)
+        if filters:
+            stream_write = LineFilter(write=stream_write, **filters)
+        spool = None
+        if spool_dir is not None:
+            spool = Spool(spool_dir, build)
+            spools.append(spool.path)
+        streams.append(stream_build(host, build, limit, stream_write, port,
+                                    output, spool))
+    streams = asyncio.ensure_future(asyncio.gather(*streams))
+    try:
+        # Give up if whatever we are writing to goes away
+        await asyncio.wait([streams, output.closed],
+                           return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        if not streams.done():
+            streams.cancel()
+        await output.close()
+        output.report()
+        if spool_dir is not None:
+            evict_spools(spool_dir, spool_size, spools)
+    if streams.done() and not streams.cancelled():
+        streams.result()
 
 
 def main():
@@ -92,88 +812,83 @@ def main():
     except Exception:
         lnav = None
     parser = argparse.ArgumentParser()
-    parser.add_argument('build', metavar='BUILD',
-                        help='Build URL or UUID')
+    parser.add_argument('builds', metavar='BUILD', nargs='+',
+                        help='Build URL or UUID, optionally as JOB=BUILD')
+    parser.add_argument('--max-streams', type=int, default=MAX_STREAMS,
+                        help=('Stream at most this many builds at a time '
+                              '(default %(default)s)'))
     parser.add_argument('--debug', action='store_true',
                         help='Enable verbose debug logging')
     parser.add_argument('--lnav', default=lnav,
                         help=('Pipe to this lnav binary (set to empty '
                               'to disable)'))
+    parser.add_argument('--spool-dir', default=SPOOL_DIR,
+                        help='Keep copies of streamed consoles here')
+    parser.add_argument('--spool-size', type=int, default=SPOOL_SIZE,
+                        help=('Megabytes of spooled consoles to keep '
+                              '(default %(default)s)'))
+    parser.add_argument('--no-spool', action='store_true',
+                        help="Don't keep a copy of what is streamed")
+    parser.add_argument('--grep', metavar='PATTERN',
+                        help=('Show lines matching this regex from the '
+                              'spool instead of streaming'))
+    parser.add_argument('--include', metavar='PATTERN', action='append',
+                        default=[],
+                        help=('Only show lines matching this regex (may be '
+                              'given more than once)'))
+    parser.add_argument('--exclude', metavar='PATTERN', action='append',
+                        default=[],
+                        help=('Never show lines matching this regex (may be '
+                              'given more than once)'))
+    parser.add_argument('-C', '--context', metavar='N', type=int, default=0,
+                        help='Show N lines either side of included lines')
+    parser.add_argument('--no-highlight', action='store_true',
+                        help=("Don't highlight errors and warnings on a "
+                              "terminal"))
+    parser.add_argument('--tail', metavar='N', type=int,
+                        help=('Show the last N lines (of matches with '
+                              '--grep) from the spool instead of '
+                              'streaming'))
     args = parser.parse_args()
-    if args.build.startswith('http'):
-        url = urllib.parse.urlparse(args.build)
-        path = url.path.split('/')
-        build = path[path.index('stream') + 1]
-        host = url.hostname
-    else:
-        build = args.build
-        host = 'zuul.opendev.org'
+    builds = [parse_build(build) for build in args.builds]
 
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
 
+    if args.grep is not None or args.tail is not None:
+        sys.exit(0 if show_spools(builds, args.grep, args.tail,
+                                  args.spool_dir) else 1)
+
     loop = asyncio.new_event_loop()
-    startpos = 0
 
+    pipe = None
     if args.lnav:
-        p = subprocess.Popen([args.lnav], stdin=subprocess.PIPE, text=True,
-            bufsize=0)
-        sys.stdout.close()
-        sys.stdout = p.stdin
-
-    # Keep reconnecting until we get an obvious end-of-stream
-    while True:
-        end = loop.create_future()
-        LOG.debug('Connecting to %s...', host)
-        conn = loop.create_connection(
-            lambda: FingerProtocol(build, end, startpos),
-            host, 79)
-        loop.create_task(conn)
-        try:
-            startpos = loop.run_until_complete(end)
-        except KeyboardInterrupt:
-            break
-        if startpos is None:
-            # None means end of stream, don't restart
-            break
+        p = subprocess.Popen([args.lnav], stdin=subprocess.PIPE)
+        pipe = p.stdin
+    filters = {'include': args.include, 'exclude': args.exclude,
+               'context': args.context,
+               # lnav does its own
+               'highlight': (not args.lnav and not args.no_highlight and
+                             sys.stdout.isatty())}
+    if not any(filters.values()):
+        filters = None
+
+    try:
+        loop.run_until_complete(stream_builds(
+            builds, args.max_streams, pipe=pipe,
+            spool_dir=None if args.no_spool else args.spool_dir,
+            spool_size=args.spool_size, filters=filters))
+    except KeyboardInterrupt:
+        # Let the streams finish off their spools
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks,
+                                               return_exceptions=True))
 
     if args.lnav:
         p.stdin.close()
         p.wait()
 
 
-class TestCase(unittest.TestCase):
-    def setUp(self):
-        pass
-        # logging.basicConfig(level=logging.DEBUG)
-
-    @mock.patch('sys.stdout.write')
-    def test_resume_zero(self, mock_print):
-        p = FingerProtocol('', None, 0)
-        p.data_received(b'abc')
-        p.data_received(b'def')
-        mock_print.assert_has_calls([
-            mock.call('abc'), mock.call('def'),
-        ])
-
-    @mock.patch('sys.stdout.write')
-    def test_resume_nonzero(self, mock_print):
-        p = FingerProtocol('', None, 4)
-        p.data_received(b'abc')
-        p.data_received(b'def')
-        p.data_received(b'ghi')
-        p.data_received(b'jkl')
-        mock_print.assert_has_calls([
-            mock.call('ef'), mock.call('ghi'), mock.call('jkl'),
-        ])
-
-    @mock.patch('sys.stdout.write')
-    def test_resume_unicode(self, mock_print):
-        p = FingerProtocol('', None, 0)
-        data = b'\xf0\x9f\x92\xa9' * 2
-        p.data_received(data[:2])
-        p.data_received(data[2:])
-        mock_print.assert_called_once_with(data.decode())
-
-
 if __name__ == '__main__':
     main()
@@ -1,9 +1,36 @@
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from http import server as http_server
+from unittest import mock
 
 import mox
 import paramiko
 
 import dash
+import fakeserver
+
+try:
+    from oslo_config import cfg
+except ImportError:
+    cfg = None
+
+# Seconds that importing dash may spend importing other modules. It is run
+# from shell prompts and status bars, so keep it quick.
+DASH_IMPORT_BUDGET = 0.05
+LAZY_MODULES = ('colorama', 'concurrent.futures', 'gzip', 'http.client',
+                'http.server', 'ijson', 'oslo_config', 'pprint', 'requests',
+                'ssl', 'urllib3')
 
 
 class TestDash(unittest.TestCase):
@@ -11,6 +38,29 @@ class TestDash(unittest.TestCase):
         super(TestDash, self).setUp()
         self.mox = mox.Mox()
 
+    def _import_dash(self, code=''):
+        return subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import dash' + code],
+            cwd=os.path.dirname(os.path.abspath(dash.__file__)),
+            capture_output=True, text=True, check=True)
+
+    def test_import_is_lazy(self):
+        result = self._import_dash('; import json, sys; '
+                                   'print(json.dumps(list(sys.modules)))')
+        self.assertFalse(set(LAZY_MODULES) & set(json.loads(result.stdout)))
+
+    def test_import_time_budget(self):
+        # What dash itself takes depends on whether its bytecode is cached,
+        # so only count the modules it pulls in, at best of three.
+        spent = []
+        for _ in range(3):
+            result = self._import_dash()
+            line = [line for line in result.stderr.splitlines()
+                    if line.endswith('| dash')][0]
+            own, total = [int(t) for t in line.split(':')[1].split('|')[:2]]
+            spent.append((total - own) / 1000000.0)
+        self.assertLess(min(spent), DASH_IMPORT_BUDGET)
+
     def test_make_filter(self):
         result = dash.make_filter('foo', 'bar', 'MYOP')
         self.assertEqual('foo:bar', result)
@@ -26,9 +76,9 @@ class TestDash(unittest.TestCase):
                        {'result': 'FAILED', 'voting': False},
                        ]}
 
-        complete, okay = dash.get_job_status(change)
-        self.assertEqual(66, complete)
-        self.assertEqual('yes', okay)
+        status = dash.get_job_status(change)
+        self.assertEqual(66, status.percent)
+        self.assertEqual('yes', status.okay)
 
     def test_get_job_status_notokay(self):
 
@@ -38,9 +88,9 @@ class TestDash(unittest.TestCase):
                        {'result': 'FAILED', 'voting': True},
                        ]}
 
-        complete, okay = dash.get_job_status(change)
-        self.assertEqual(66, complete)
-        self.assertEqual('no', okay)
+        status = dash.get_job_status(change)
+        self.assertEqual(66, status.percent)
+        self.assertEqual('no', status.okay)
 
     def test_get_job_status_maybe(self):
 
@@ -50,17 +100,17 @@ class TestDash(unittest.TestCase):
                        {'result': 'ABORTED', 'voting': True},
                        ]}
 
-        complete, okay = dash.get_job_status(change)
-        self.assertEqual(66, complete)
-        self.assertEqual('maybe', okay)
+        status = dash.get_job_status(change)
+        self.assertEqual(66, status.percent)
+        self.assertEqual('maybe', status.okay)
 
     def test_get_job_status_no_jobs(self):
 
         change = {'jobs': []}
 
-        complete, okay = dash.get_job_status(change)
-        self.assertEqual(0, complete)
-        self.assertEqual(None, okay)
+        status = dash.get_job_status(change)
+        self.assertEqual(0, status.percent)
+        self.assertEqual(None, status.okay)
 
     def test_get_change_id(self):
         self.assertEqual(1234, dash.get_change_id({'id': '1234,10'}))
@@ -75,6 +125,744 @@ class TestDash(unittest.TestCase):
                           456: {'subject': 'bar', 'owner': 'dan'},
                           }, result)
 
+    def _zuul_change(self, number, pipeline='check'):
+        return {'id': '%i,1' % number, 'enqueue_time': 0,
+                'jobs': [{'pipeline': pipeline, 'result': None,
+                          'voting': True, 'start_time': None}]}
+
+    def _zuul_data(self):
+        change = self._zuul_change
+        return {'message': 'hello',
+                'trigger_event_queue': {'length': 3},
+                'pipelines': [
+                    {'name': 'check',
+                     'change_queues': [
+                         {'heads': [[change(1)],
+                                    [change(2), change(3)],
+                                    [change(4)]]},
+                         {'heads': [[change(5)]]}]},
+                    {'name': 'gate',
+                     'change_queues': [
+                         {'heads': [[change(6, 'gate'), change(7, 'gate'),
+                                     change(8, 'gate')],
+                                    [change(9, 'gate')]]}]}]}
+
+    def _watched_changes(self):
+        return [{u'number': n, u'subject': 'foo', u'owner': {}}
+                for n in (3, 5, 9)]
+
+    def test_filter_zuul_status(self):
+        changes = self._watched_changes()
+        expected = dash.find_changes_in_zuul(self._zuul_data(), changes, [])
+        zuul_data = dash._filter_zuul_status(self._zuul_data(), {3, 5, 9})
+        self.assertEqual(expected,
+                         dash.find_changes_in_zuul(zuul_data, changes, []))
+        self.assertEqual([{'_skip': 3}],
+                         zuul_data['pipelines'][1]['change_queues'][0][
+                             'heads'][0])
+
+    @unittest.skipIf(dash._import_ijson() is None, 'ijson is not installed')
+    def test_stream_zuul_status(self):
+        changes = self._watched_changes()
+        expected = dash.find_changes_in_zuul(self._zuul_data(), changes, [])
+        stream = io.BytesIO(json.dumps(self._zuul_data()).encode())
+        zuul_data = dash._stream_zuul_status(stream, lambda: {3, 5, 9})
+        self.assertEqual(expected,
+                         dash.find_changes_in_zuul(zuul_data, changes, []))
+        self.assertEqual('hello', zuul_data['message'])
+        self.assertEqual({'length': 3}, zuul_data['trigger_event_queue'])
+
+    def test_zuul_snapshot_within_ttl(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.addCleanup(setattr, dash, 'CACHE_DIR', dash.CACHE_DIR)
+        dash.CACHE_DIR = cache_dir
+        url = 'https://zuul.example.com/api/status'
+        body = io.BytesIO(json.dumps(self._zuul_data()).encode())
+        writer = dash._SnapshotWriter(url, body, False)
+        self.assertTrue(writer.commit())
+        dash._save_snapshot_meta(url, {'url': url, 'etag': '"1"',
+                                       'fetched': time.time()})
+        # Nothing is listening on that url, so this must come from disk
+        zuul_data = dash._get_zuul_status(cache_ttl=60, url=url)
+        self.assertEqual(self._zuul_data(), zuul_data)
+
+    def test_delta(self):
+        old = ['a', 'b', 'c', 'd', 'e', 'f']
+        new = ['x', 'a', 'b', 'c', 'y', 'e', 'f', 'b', 'c']
+        ops = dash.make_delta(old, new)
+        self.assertEqual(['x', [0, 3], 'y', [4, 2], [1, 2]], ops)
+        self.assertEqual(new, dash.apply_delta(old, ops))
+
+    def test_record_replay(self):
+        record_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, record_dir)
+        changes = self._watched_changes()
+        snapshots = []
+        recorder = dash.Recorder(record_dir, segment_size=2)
+        for number in range(3):
+            zuul_data = self._zuul_data()
+            zuul_data['pipelines'][0]['change_queues'][1]['heads'].append(
+                [self._zuul_change(number)])
+            with contextlib.redirect_stdout(io.StringIO()):
+                dash.do_dashboard(None, 'me', {}, False, False, 'AND', [],
+                                  None, [], recorder=recorder,
+                                  snapshot=(changes, zuul_data))
+            snapshots.append(zuul_data)
+        recorder.close()
+
+        self.assertEqual(2, len(os.listdir(record_dir)))
+        records = list(dash.replay_records(record_dir))
+        self.assertEqual(snapshots, [r['zuul'] for r in records])
+        self.assertEqual([changes] * 3, [r['gerrit'] for r in records])
+
+    def test_build_queries_single(self):
+        self.assertEqual(
+            ['((owner:baz) AND (project:foo OR project:bar)) AND status:open'],
+            dash.build_queries({'owner': 'baz'}, 'AND', ['foo', 'bar'],
+                               None))
+
+    def test_build_queries_sharded_changes(self):
+        queries = dash.build_queries({'change': ['1', '2', '3']}, 'OR',
+                                     ['foo'], None, shard_size=2)
+        self.assertEqual(['((change:1 OR change:2)) AND status:open',
+                          '((change:3 OR project:foo)) AND status:open'],
+                         queries)
+
+    def test_build_queries_sharded_projects(self):
+        queries = dash.build_queries({'owner': 'baz'}, 'AND',
+                                     ['foo', 'bar', 'bat'], None,
+                                     shard_size=2)
+        self.assertEqual(
+            ['((owner:baz) AND (project:foo OR project:bar)) AND status:open',
+             '((owner:baz) AND (project:bat)) AND status:open'],
+            queries)
+
+    @mock.patch('dash._query_gerrit')
+    def test_fetch_changes_pages(self, mock_query):
+        def fake_query(auth, query, start, limit, options):
+            numbers = {'a': [1, 2, 3, 4, 5], 'b': [5, 6]}[query]
+            page = [{'_number': n} for n in numbers[start:start + limit]]
+            if start + limit < len(numbers):
+                page[-1]['_more_changes'] = True
+            return page
+
+        mock_query.side_effect = fake_query
+        changes = dash.fetch_changes('auth', ['a', 'b'], page_size=2)
+        self.assertEqual([6, 5, 4, 3, 2, 1],
+                         [c['_number'] for c in changes])
+        self.assertNotIn('_more_changes', changes[-2])
+
+    @mock.patch('dash.get_pending_changes')
+    def test_get_changes_incremental(self, mock_get):
+        self.addCleanup(dash.CACHE.pop, 'gerrit', None)
+        mock_get.side_effect = [
+            [{'_number': 2, 'status': 'NEW'},
+             {'_number': 1, 'status': 'NEW'}],
+            [{'_number': 1, 'status': 'MERGED'},
+             {'_number': 3, 'status': 'NEW', 'updated': '2'}],
+            [{'_number': 4, 'status': 'NEW'}],
+        ]
+        args = (('user', 'pass'), {'owner': 'foo'}, 'AND', [], None)
+
+        options = dash.GERRIT_OPTIONS
+        changes = dash.get_changes_incremental(*args)
+        self.assertEqual([2, 1], [c['_number'] for c in changes])
+        mock_get.assert_called_with(*args, options=options)
+
+        changes = dash.get_changes_incremental(*args)
+        self.assertEqual([3, 2], [c['_number'] for c in changes])
+        mock_get.assert_called_with(*args, status=None,
+                                    age=dash.GERRIT_AGE_SLACK,
+                                    options=options)
+
+        # Time for a full resync
+        changes = dash.get_changes_incremental(*args, resync=0)
+        self.assertEqual([4], [c['_number'] for c in changes])
+        mock_get.assert_called_with(*args, options=options)
+
+    def _gerrit_cache(self, *args):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.addCleanup(setattr, dash, 'CACHE_DIR', dash.CACHE_DIR)
+        dash.CACHE_DIR = cache_dir
+        return dash.GerritCache(*args)
+
+    def test_gerrit_cache_opt_in(self):
+        parser = dash.make_parser()
+        self.assertIsNone(dash.make_gerrit_cache(parser.parse_args([])))
+        cache = dash.make_gerrit_cache(parser.parse_args(
+            ['--gerrit-cache-ttl', '30']))
+        self.assertEqual(30, cache.ttl)
+
+    def _age_cache(self, seconds):
+        cache_dir = os.path.join(dash.CACHE_DIR, 'gerrit')
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            with open(path) as f:
+                entry = json.load(f)
+            entry['fetched'] -= seconds
+            with open(path, 'w') as f:
+                json.dump(entry, f)
+
+    @mock.patch('dash.get_pending_changes')
+    def test_gerrit_cache(self, mock_get):
+        cache = self._gerrit_cache(60)
+        mock_get.side_effect = [[{'_number': 1}], [{'_number': 2}]]
+        args = (('user', 'pass'), {'owner': 'foo'}, 'AND', [], None)
+        self.assertEqual([{'_number': 1}], cache.get_pending_changes(*args))
+        self.assertEqual([{'_number': 1}], cache.get_pending_changes(*args))
+        self.assertEqual(1, mock_get.call_count)
+        # Someone else asking the same thing gets their own results
+        self.assertEqual([{'_number': 2}], cache.get_pending_changes(
+            ('other', 'pass'), *args[1:]))
+        self.assertEqual(2, mock_get.call_count)
+
+    @mock.patch('dash.get_pending_changes')
+    def test_gerrit_cache_stale_while_revalidate(self, mock_get):
+        cache = self._gerrit_cache(60, 60)
+        mock_get.side_effect = [[{'_number': 1}], [{'_number': 2}]]
+        args = (('user', 'pass'), {'owner': 'foo'}, 'AND', [], None)
+        cache.get_pending_changes(*args)
+        self._age_cache(90)
+        with mock.patch('threading.Thread') as mock_thread:
+            self.assertEqual([{'_number': 1}],
+                             cache.get_pending_changes(*args))
+        # Refresh in the foreground rather than racing a thread
+        target = mock_thread.call_args[1]
+        target['target'](*target['args'])
+        self.assertEqual([{'_number': 2}], cache.get_pending_changes(*args))
+        self.assertEqual(2, mock_get.call_count)
+
+    @mock.patch('dash.get_pending_changes')
+    def test_gerrit_cache_evicts_least_recently_used(self, mock_get):
+        cache = self._gerrit_cache(60)
+        mock_get.side_effect = lambda *args, **kwargs: [
+            {'_number': 1, 'subject': 'x' * 1000}]
+        for owner in ('a', 'b', 'a', 'c'):
+            cache.get_pending_changes(('user', 'pass'), {'owner': owner},
+                                      'AND', [], None)
+            time.sleep(0.01)
+        # Room for three entries
+        cache.size = 3500
+        cache.get_pending_changes(('user', 'pass'), {'owner': 'd'}, 'AND',
+                                  [], None)
+        self.assertEqual(4, mock_get.call_count)
+        # b was used longest ago, and a was used after it
+        mock_get.reset_mock()
+        cache.get_pending_changes(('user', 'pass'), {'owner': 'a'}, 'AND',
+                                  [], None)
+        self.assertEqual(0, mock_get.call_count)
+        cache.get_pending_changes(('user', 'pass'), {'owner': 'b'}, 'AND',
+                                  [], None)
+        self.assertEqual(1, mock_get.call_count)
+
+    def test_choose_zuul_strategy(self):
+        self.assertEqual('change', dash.choose_zuul_strategy(
+            {'change': ['1', '2']}, [], None))
+        self.assertEqual('tenant', dash.choose_zuul_strategy(
+            {'change': ['1'], 'owner': 'foo'}, [], None))
+        self.assertEqual('tenant', dash.choose_zuul_strategy(
+            {}, ['openstack/nova'], None))
+        self.assertEqual('global', dash.choose_zuul_strategy(
+            {'change': ['1']}, [], None, 'global'))
+
+    def test_match_changes_in_zuul(self):
+        changes = self._watched_changes() + [
+            {u'number': 10, u'subject': 'bar', u'owner': {}}]
+        results, queue_stats, not_found = dash.match_changes_in_zuul(
+            self._zuul_data(), changes, [])
+        self.assertEqual({'check': 4, 'gate': 4}, queue_stats)
+        self.assertEqual([(2, '3,1'), (4, '5,1')],
+                         [(r['pos'], r['id']) for r in results['check']])
+        self.assertEqual([(4, '9,1')],
+                         [(r['pos'], r['id']) for r in results['gate']])
+        self.assertEqual({10}, not_found)
+
+    def test_match_changes_in_zuul_ignore_queue(self):
+        results, queue_stats, not_found = dash.match_changes_in_zuul(
+            self._zuul_data(), self._watched_changes(), ['gate'])
+        self.assertEqual({'check': 4}, queue_stats)
+        self.assertEqual({9}, not_found)
+
+    def test_queue_entry_compat(self):
+        entry = dash.make_queue_entry(
+            3, self._zuul_change(1), {'subject': 'foo', 'owner': 'dan'})
+        self.assertEqual(3, entry['pos'])
+        self.assertEqual('1,1', entry['id'])
+        self.assertIsNone(entry.get('starred'))
+        self.assertRaises(KeyError, lambda: entry['nope'])
+        self.assertEqual((0, None), (entry['status'].percent,
+                                     entry['status'].okay))
+        self.assertEqual('_', entry.status.status)
+
+    def test_owner_shared(self):
+        owner = {'_account_id': 1, 'username': 'dan'}
+        changes = [{u'number': 1, u'subject': 'foo', u'owner': owner},
+                   {u'number': 2, u'subject': 'bar', u'owner': dict(owner)}]
+        change_ids = dash.get_change_ids(changes)
+        self.assertIs(change_ids[1]['owner'], change_ids[2]['owner'])
+        self.assertEqual('dan', change_ids[1]['owner'].get('username'))
+        # The next fetch sees the new name
+        changes[0]['owner'] = dict(owner, name='Dan')
+        change_ids = dash.get_change_ids(changes)
+        self.assertEqual('Dan', change_ids[1]['owner'].get('name'))
+        self.assertIsNot(change_ids[1]['owner'], change_ids[2]['owner'])
+        # Owners we know nothing unique about aren't merged
+        change_ids = dash.get_change_ids([
+            {u'number': 1, u'subject': 'foo', u'owner': {'name': 'a'}},
+            {u'number': 2, u'subject': 'bar', u'owner': {'name': 'b'}}])
+        self.assertEqual('b', change_ids[2]['owner'].get('name'))
+
+    @mock.patch('shutil.get_terminal_size')
+    def test_diff_renderer(self, mock_size):
+        mock_size.return_value = mock.Mock(columns=80, lines=5)
+        stream = io.StringIO()
+        renderer = dash.DiffRenderer(stream)
+        renderer.render(['head', 'a', 'b'])
+        self.assertTrue(stream.getvalue().startswith('\033[H\033[2J'))
+
+        stream.seek(0)
+        stream.truncate()
+        renderer.render(['head', 'a', 'c'])
+        self.assertEqual('\033[3;1Hc\033[K\033[4;1H', stream.getvalue())
+
+        stream.seek(0)
+        stream.truncate()
+        renderer.render(['head', '1', '2', '3', '4', '5'])
+        self.assertIn('-- 3 of 5 lines --', stream.getvalue())
+        # The same page again, so there is nothing to redraw
+        stream.seek(0)
+        stream.truncate()
+        renderer.render(['head', '1', '2', '3', '4', '5'])
+        self.assertEqual('\033[5;1H', stream.getvalue())
+
+    def test_diff_renderer_tiny(self):
+        frame = ['head', '1', '2', '3']
+        renderer = dash.DiffRenderer(io.StringIO())
+        for lines in range(5):
+            self.assertLessEqual(len(renderer._viewport(frame, 80, lines)),
+                                 lines)
+        self.assertEqual(['head', '-- 0 of 3 lines --'],
+                         renderer._viewport(frame, 80, 2))
+
+    def _start_server(self, server):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_address
+
+    def _start_fake_zuul(self):
+        zuul_data = json.dumps(self._zuul_data()).encode()
+        hits = []
+
+        class FakeZuul(http_server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                hits.append(self.path)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(zuul_data)))
+                self.end_headers()
+                self.wfile.write(zuul_data)
+
+            def log_message(self, *args):
+                pass
+
+        server = http_server.ThreadingHTTPServer(('127.0.0.1', 0), FakeZuul)
+        host, port = self._start_server(server)
+        self.addCleanup(setattr, dash, 'ZUUL_URL', dash.ZUUL_URL)
+        dash.ZUUL_URL = 'http://%s:%i' % (host, port)
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.addCleanup(setattr, dash, 'CACHE_DIR', dash.CACHE_DIR)
+        dash.CACHE_DIR = cache_dir
+        self.addCleanup(dash.CACHE.clear)
+        return hits
+
+    @mock.patch('dash.get_account_id')
+    @mock.patch('dash.get_pending_changes')
+    def test_dashboard_daemon(self, mock_get, mock_account):
+        hits = self._start_fake_zuul()
+        mock_get.return_value = [dict(c, _number=c['number'])
+                                 for c in self._watched_changes()]
+        daemon = dash.DashboardDaemon(('user', 'pass'), 60)
+        server = dash.make_dashboard_server('127.0.0.1:0', daemon)
+        address = '127.0.0.1:%i' % self._start_server(server)[1]
+
+        opts = dash.params_to_opts({'owner': ['me'], 'user': ['me']})
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            bodies = list(pool.map(
+                lambda _: dash.fetch_dashboard(address, opts), range(4)))
+
+        self.assertEqual(1, len(set(bodies)))
+        self.assertIn('(3,1', bodies[0])
+        self.assertIn('Queue: gate (1/4)', bodies[0])
+        # Everyone shared one zuul and one gerrit fetch
+        self.assertEqual(['/api/tenant/openstack/status'], hits)
+        self.assertEqual(1, mock_get.call_count)
+
+    def test_dashboard_daemon_retries_failures(self):
+        daemon = dash.DashboardDaemon(('user', 'pass'), 60)
+        fetch = mock.Mock(side_effect=[Exception('boom'), 'ok', 'again'])
+        future = daemon._coalesce(('key',), fetch)
+        self.assertRaises(Exception, future.result)
+        self.assertEqual('ok', daemon._coalesce(('key',), fetch).result())
+        # Success is kept for the interval
+        self.assertEqual('ok', daemon._coalesce(('key',), fetch).result())
+        self.assertEqual(2, fetch.call_count)
+
+    def test_dashboard_daemon_rejects_per_user_opts(self):
+        self.assertRaises(ValueError, dash.params_to_opts,
+                          {'starred': ['1'], 'user': ['me']})
+        self.assertRaises(ValueError, dash.params_to_opts,
+                          {'watched': ['1']})
+        self.assertRaises(ValueError, dash.params_to_opts,
+                          {'query': ['is:open']})
+        self.assertFalse(dash.params_to_opts({'jenkins': ['1']}).starred)
+
+    @mock.patch('dash.add_labels')
+    @mock.patch('dash.get_account_id')
+    @mock.patch('dash.get_pending_changes')
+    def test_dashboard_daemon_labels_copies(self, mock_get, mock_account,
+                                            mock_labels):
+        self._start_fake_zuul()
+        # 42 isn't in zuul, so -j looks up its labels
+        changes = [dict(c, _number=c['number'])
+                   for c in self._watched_changes() + [
+                       {u'number': 42, u'subject': 'bar', u'owner': {}}]]
+        mock_get.return_value = changes
+
+        def add_labels(auth_creds, changes, numbers):
+            for change in changes:
+                if change['number'] in numbers:
+                    change['labels'] = {}
+        mock_labels.side_effect = add_labels
+        daemon = dash.DashboardDaemon(('user', 'pass'), 60)
+        daemon.dashboard(dash.params_to_opts({'owner': ['me'],
+                                              'jenkins': ['1']}))
+        self.assertTrue(mock_labels.called)
+        # What other clients share is left alone
+        self.assertFalse([c for c in changes if 'labels' in c])
+
+    def test_jenkins_info_without_patchset(self):
+        info = dash.get_jenkins_info([{'number': 5, 'subject': 'foo',
+                                       'owner': {'_account_id': 1}}])
+        self.assertEqual('5', info[0]['id'])
+        self.assertEqual('0', info[0]['score'])
+
+    @mock.patch.object(dash, 'DAEMON_CACHE_SIZE', 2)
+    def test_dashboard_daemon_evicts(self):
+        daemon = dash.DashboardDaemon(('user', 'pass'), 60)
+        fetch = mock.Mock(return_value='ok')
+        for key in ('a', 'b', 'a', 'c'):
+            daemon._coalesce((key,), fetch).result()
+        # b was the least recently used
+        self.assertEqual([('a',), ('c',)], sorted(daemon._fetches))
+        self.assertEqual(3, fetch.call_count)
+
+    @mock.patch('dash.get_account_id')
+    @mock.patch('dash.get_pending_changes')
+    def test_dashboard_daemon_rerenders(self, mock_get, mock_account):
+        self._start_fake_zuul()
+        mock_get.return_value = [dict(c, _number=c['number'])
+                                 for c in self._watched_changes()]
+        daemon = dash.DashboardDaemon(('user', 'pass'), 60)
+        opts = dash.params_to_opts({'owner': ['me'], 'user': ['me']})
+        lines = daemon.dashboard(opts)
+        self.assertIs(lines, daemon.dashboard(opts))
+        # The same data, but how long ago things happened has moved on
+        with mock.patch.object(dash, 'DAEMON_RENDER_TTL', 0):
+            self.assertIsNot(lines, daemon.dashboard(opts))
+        self.assertEqual(1, mock_get.call_count)
+
+    def test_is_unix_address(self):
+        for address in ('dash.sock', '/tmp/dash.sock', './dash:1'):
+            self.assertTrue(dash._is_unix_address(address), address)
+        for address in ('127.0.0.1:8080', ':8080', '[::1]:8080'):
+            self.assertFalse(dash._is_unix_address(address), address)
+
+    def test_dashboard_daemon_unix_socket(self):
+        sock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sock_dir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(sock_dir)
+        daemon = mock.Mock()
+        daemon.dashboard.return_value = ['hello', 'world']
+        self._start_server(dash.make_dashboard_server('dash.sock', daemon))
+        self.assertEqual('hello\nworld\n', dash.fetch_dashboard(
+            'dash.sock', dash.params_to_opts({})))
+
+    def test_zuul_status_timings(self):
+        self._start_fake_zuul()
+        self.addCleanup(dash.TIMINGS.clear)
+        dash.reset_timings()
+        dash.get_zuul_status(strategy='tenant')
+        size = len(json.dumps(self._zuul_data()).encode())
+        self.assertEqual(size, dash.TIMINGS['zuul']['bytes'])
+        self.assertEqual(size, dash.TIMINGS['parse']['bytes'])
+        self.assertNotIn('gunzip', dash.TIMINGS)
+        self.assertIn('zuul', dash.timing_lines()[0])
+
+    def test_zuul_connection_reuse(self):
+        hits = self._start_fake_zuul()
+        nrequests, nconnections = dash.zuul_connection_stats()
+        for _ in range(3):
+            dash.get_zuul_status(strategy='tenant')
+        self.assertEqual(3, len(hits))
+        self.assertEqual((nrequests + 3, nconnections + 1),
+                         dash.zuul_connection_stats())
+
+    def _start_fake_server(self, **kwargs):
+        backend = fakeserver.Backend(queue_depth=50, jobs=3, watched=20,
+                                     **kwargs)
+        host, port = self._start_server(fakeserver.make_server(backend))
+        url = 'http://%s:%i' % (host, port)
+        for name in ('GERRIT_URL', 'ZUUL_URL', 'ZUUL_STATUS_URL'):
+            self.addCleanup(setattr, dash, name, getattr(dash, name))
+        dash.set_endpoints(url, url)
+        self.addCleanup(dash.CACHE.clear)
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.addCleanup(setattr, dash, 'CACHE_DIR', dash.CACHE_DIR)
+        dash.CACHE_DIR = cache_dir
+        return backend
+
+    def test_first_fetches_are_concurrent(self):
+        # A fresh interpreter, so the http modules are first imported by
+        # the dashboard itself while its worker threads are starting up
+        script = """if True:
+            import concurrent.futures, sys, tempfile, threading
+            import dash, fakeserver
+            server = fakeserver.make_server(fakeserver.Backend(
+                queue_depth=50, jobs=3, watched=20))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = 'http://127.0.0.1:%i' % server.server_address[1]
+            dash.set_endpoints(url, url)
+            dash.CACHE_DIR = tempfile.mkdtemp()
+            daemon = dash.DashboardDaemon(('user', 'pass'), 60)
+            opts = dash.params_to_opts({'owner': ['user1'],
+                                        'user': ['user1']})
+            with concurrent.futures.ThreadPoolExecutor(4) as pool:
+                for lines in pool.map(daemon.dashboard, [opts] * 4):
+                    print(lines[-1])
+        """
+        for _ in range(3):
+            result = subprocess.run(
+                [sys.executable, '-c', script],
+                cwd=os.path.dirname(os.path.abspath(dash.__file__)),
+                capture_output=True, text=True, check=True)
+            self.assertNotIn('Failed', result.stdout)
+            self.assertEqual(4, len(result.stdout.splitlines()))
+
+    def test_fake_server(self):
+        backend = self._start_fake_server(page_cap=7)
+        queries = dash.build_queries([], 'AND', [], 'status:open')
+        changes = dash.fetch_changes(None, queries, page_size=7)
+        # Three pages of at most seven
+        self.assertEqual(20, len(changes))
+        self.assertEqual(sorted(c['number'] for c in backend.changes),
+                         sorted(c['_number'] for c in changes))
+        watched = dash.get_change_ids(changes)
+        for strategy in ('global', 'tenant', 'change'):
+            zuul_data = dash.get_zuul_status(watched, strategy=strategy)
+            matched = dash.match_changes_in_zuul(zuul_data, changes, [])
+            self.assertEqual(4, len(matched[2]), strategy)
+
+    def test_account_id_cached_on_disk(self):
+        self._start_fake_server()
+        auth = ('user', 'pass')
+        with mock.patch.object(dash, 'get_session',
+                               wraps=dash.get_session) as get_session:
+            self.assertEqual(0, dash.get_account_id(auth, 'user0'))
+            self.assertIsNone(dash.get_account_id(auth, 'nobody'))
+            self.assertEqual(2, get_session.call_count)
+            self.assertEqual([], dash.account_lines('user0'))
+            self.assertIn('nobody', dash.account_lines('nobody')[0])
+            # A refresh doesn't ask again straight away
+            self.assertIsNone(dash.get_account_id(auth, 'nobody'))
+            self.assertEqual(2, get_session.call_count)
+            with mock.patch.object(dash, 'ACCOUNT_RETRY', 0):
+                self.assertIsNone(dash.get_account_id(auth, 'nobody'))
+            self.assertEqual(3, get_session.call_count)
+            # A new run finds the id on disk, but tries the failure again
+            dash.CACHE.clear()
+            self.assertEqual(0, dash.get_account_id(auth, 'user0'))
+            self.assertEqual(3, get_session.call_count)
+            self.assertIsNone(dash.get_account_id(auth, 'nobody'))
+            self.assertEqual(4, get_session.call_count)
+
+    def test_set_endpoints(self):
+        for name in ('GERRIT_URL', 'ZUUL_URL', 'ZUUL_STATUS_URL'):
+            self.addCleanup(setattr, dash, name, getattr(dash, name))
+        self.assertTrue(dash.ZUUL_STATUS_URL.startswith(dash.ZUUL_URL + '/'))
+        dash.set_endpoints('https://gerrit.example.com/',
+                           'https://zuul.example.com/')
+        self.assertEqual('https://gerrit.example.com', dash.GERRIT_URL)
+        self.assertEqual('https://zuul.example.com/api/status',
+                         dash.ZUUL_STATUS_URL)
+
+    def test_zuul_per_change_not_snapshotted(self):
+        self._start_fake_server()
+        changes = dash.get_pending_changes(('user', 'pass'), {}, 'AND', [],
+                                           None, options=('CURRENT_REVISION',))
+        watched = dash.get_change_ids(changes)
+        zuul_data = dash.get_zuul_status(watched, strategy='change')
+        self.assertTrue(zuul_data['_partial'])
+        self.assertEqual([], os.listdir(dash.CACHE_DIR))
+        self.assertNotIn('zuul_snapshot', dash.CACHE)
+
+    def test_jenkins_labels(self):
+        self._start_fake_server()
+        auth = ('user', 'pass')
+        changes = dash.get_pending_changes(auth, {}, 'AND', [], None)
+        # The first query is lean
+        self.assertNotIn('labels', changes[0])
+        self.assertEqual(['_account_id'], list(changes[0]['owner']))
+        zuul_data = dash.get_zuul_status(strategy='tenant')
+        results, queue_stats, not_found = dash.match_changes_in_zuul(
+            zuul_data, changes, [])
+        self.assertEqual(0, dash.get_account_id(auth, 'user0'))
+        dash.add_labels(auth, changes, not_found)
+        self.assertEqual(not_found, set(c['number'] for c in changes
+                                        if 'labels' in c))
+
+        lines = dash.render_dashboard('user0', True, changes, zuul_data,
+                                      results, queue_stats, not_found)
+        scores = lines[lines.index('Jenkins scores:') + 1:]
+        self.assertEqual(len(not_found), len(scores))
+        for change in dash.get_jenkins_info(
+                [c for c in changes if c['number'] in not_found]):
+            self.assertIn(change['score'], ('1', '-1'))
+            self.assertTrue(change['id'].endswith(',%i' % next(
+                c['patchset'] for c in changes
+                if change['id'].startswith('%i,' % c['number']))))
+        # user0's changes are highlighted, found by account id
+        owned = [c for c in changes if c['owner']['_account_id'] == 0 and
+                 c['number'] in not_found]
+        self.assertTrue(owned)
+        for change in owned:
+            line = next(line for line in scores
+                        if '(%i,' % change['number'] in line)
+            self.assertTrue(line.startswith('\x1b'), line)
+
+    def test_write_metrics(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        self.addCleanup(dash.TIMINGS.clear)
+        dash.reset_timings()
+        dash.record_timing('zuul', 1.5, 2048)
+        with dash.timed('match'):
+            pass
+        dash.write_metrics(path)
+        with open(path) as f:
+            metrics = f.read().splitlines()
+        self.assertIn('dash_stage_seconds{stage="zuul"} 1.500000', metrics)
+        self.assertIn('dash_stage_bytes{stage="zuul"} 2048', metrics)
+        self.assertIn('# TYPE dash_stage_seconds gauge', metrics)
+        self.assertFalse([line for line in metrics
+                          if 'bytes{stage="match"}' in line])
+
+    @unittest.skipIf(cfg is None, 'oslo.config is not installed')
+    def test_osloconfig_profiles(self):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write('[DEFAULT]\nprofiles = mine,nova\nrefresh = 30\n'
+                    '[profile:mine]\nowner = me\n'
+                    '[profile:nova]\nprojects = openstack/nova\n'
+                    'change = 1,2\n')
+        parser = dash.make_parser()
+        with mock.patch.dict(os.environ, {'DASH_CONFIG_FILE': path}):
+            args = dash.osloconfig_parse(parser, parser.parse_args([]), cfg)
+            self.assertEqual(30, args.refresh)
+            self.assertEqual(['mine', 'nova'],
+                             [p.name for p in args.profiles])
+            self.assertEqual('me', args.profiles[0].owner)
+            self.assertEqual(['1', '2'], args.profiles[1].change)
+
+            args = dash.osloconfig_parse(
+                parser, parser.parse_args(['-o', 'you', '-r', '5']), cfg)
+            self.assertEqual(5, args.refresh)
+            self.assertEqual([], args.profiles)
+
+    @mock.patch('dash.get_account_id')
+    @mock.patch('dash.get_zuul_status')
+    @mock.patch('dash.get_pending_changes')
+    def test_profiles_dashboard(self, mock_get, mock_zuul, mock_account):
+        mock_zuul.return_value = self._zuul_data()
+        mock_get.side_effect = lambda auth, filters, *args: [
+            c for c in self._watched_changes()
+            if str(c['number']) in filters['change']]
+        profiles = [
+            argparse.Namespace(name=name, user='me', owner=None,
+                               change=change, projects='', topic=None,
+                               query=None, watched=False, starred=False,
+                               operator='AND', jenkins=False,
+                               ignore_queue=[])
+            for name, change in (('one', ['3']), ('two', ['9']))]
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            dash.do_profiles_dashboard(('user', 'pass'), 'me', profiles,
+                                       False)
+        output = stdout.getvalue()
+        self.assertEqual(1, mock_zuul.call_count)
+        self.assertEqual(1, output.count('Zuul: hello'))
+        self.assertLess(output.index('== one =='), output.index('(3,1'))
+        self.assertLess(output.index('== two =='), output.index('(9,1'))
+
+    def _entry(self, pos, status):
+        return dash.QueueEntry(pos, '1,1', 'foo', 'dan', False, 0,
+                               dash.JobStatus(0, status, None))
+
+    @mock.patch('random.uniform', return_value=1)
+    def test_refresh_scheduler_backoff(self, mock_uniform):
+        scheduler = dash.RefreshScheduler(10, max_interval=100)
+        self.assertEqual(20, scheduler.failed())
+        self.assertEqual(40, scheduler.failed())
+        self.assertEqual(80, scheduler.failed())
+        self.assertEqual(100, scheduler.failed())
+        self.assertIn('retry 4', scheduler.status())
+        # Stale zuul data counts as failing too
+        self.assertEqual(40, scheduler.succeeded({}, {'_retry': 2}))
+        self.assertEqual(10, scheduler.succeeded({}, {'_retry': 0}))
+        self.assertEqual(0, scheduler.failures)
+
+    @mock.patch('random.uniform', return_value=1)
+    def test_refresh_scheduler_long_outage(self, mock_uniform):
+        scheduler = dash.RefreshScheduler(10, max_interval=3600)
+        for _ in range(2000):
+            interval = scheduler.failed()
+        self.assertEqual(scheduler.MAX_BACKOFF, interval)
+
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_refresh_failed(self, mock_stdout):
+        scheduler = dash.RefreshScheduler(10)
+        renderer = mock.Mock()
+        dash.refresh_failed('Failed to get data from Zuul: boom', renderer,
+                            scheduler)
+        renderer.invalidate.assert_called_once_with()
+        self.assertEqual(1, scheduler.failures)
+        # Where the next attempt is, not just that this one failed
+        self.assertIn('Next refresh in', mock_stdout.getvalue())
+        self.assertIn('(retry 1)', mock_stdout.getvalue())
+
+    @mock.patch('random.uniform', return_value=1)
+    def test_refresh_scheduler_adaptive(self, mock_uniform):
+        scheduler = dash.RefreshScheduler(10, adaptive=True)
+        results = {'check': [self._entry(5, '++_')]}
+        self.assertEqual(10, scheduler.succeeded(results))
+        self.assertEqual(15, scheduler.succeeded(results))
+        self.assertEqual(22.5, scheduler.succeeded(results))
+        # Something started running
+        results = {'check': [self._entry(5, '++~')]}
+        self.assertEqual(5, scheduler.succeeded(results))
+        # Near the head of the gate
+        results = {'gate': [self._entry(2, '++_')]}
+        self.assertEqual(5, scheduler.succeeded(results))
+
     def _test_gerrit_query(self, query, filters, operator, projects):
         client = self.mox.CreateMockAnything()
         query = query + ' --current-patch-set'
@@ -0,0 +1,406 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import osfinger
+from osfinger import FingerProtocol
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        pass
+        # logging.basicConfig(level=logging.DEBUG)
+
+    @mock.patch('sys.stdout.write')
+    def test_resume_zero(self, mock_print):
+        p = FingerProtocol('', None, 0)
+        p.data_received(b'abc')
+        p.data_received(b'def')
+        mock_print.assert_has_calls([
+            mock.call('abc'), mock.call('def'),
+        ])
+
+    @mock.patch('sys.stdout.write')
+    def test_resume_nonzero(self, mock_print):
+        p = FingerProtocol('', None, 4)
+        p.data_received(b'abc')
+        p.data_received(b'def')
+        p.data_received(b'ghi')
+        p.data_received(b'jkl')
+        mock_print.assert_has_calls([
+            mock.call('ef'), mock.call('ghi'), mock.call('jkl'),
+        ])
+
+    @mock.patch('sys.stdout.write')
+    def test_resume_unicode(self, mock_print):
+        p = FingerProtocol('', None, 0)
+        data = b'\xf0\x9f\x92\xa9' * 2
+        p.data_received(data[:2])
+        p.data_received(data[2:])
+        mock_print.assert_called_once_with(data.decode())
+
+    def test_resume_bytes(self):
+        write = mock.Mock()
+        data = 'a\u00e9b\U0001f4a9c'.encode()
+        p = FingerProtocol('', None, 0, write)
+        p.data_received(data[:3])
+        p.data_received(data[3:5])
+        # Dropped half way through the last character
+        self.assertEqual(4, p.position)
+        p = FingerProtocol('', None, p.position, write)
+        p.data_received(data[:2])
+        self.assertEqual(4, p.position)
+        p.data_received(data[2:])
+        self.assertEqual(len(data), p.position)
+        write.assert_has_calls([
+            mock.call('a\u00e9'), mock.call('b'),
+            mock.call('\U0001f4a9c'),
+        ])
+        self.assertEqual(3, write.call_count)
+
+    def test_build_not_found(self):
+        end = mock.Mock()
+        p = FingerProtocol('', end, 0, mock.Mock())
+        p.connection_made(mock.Mock())
+        p.data_received(b'Build not found')
+        end.set_result.assert_called_once_with(None)
+
+    def test_parse_build(self):
+        self.assertEqual(
+            ('tempest', 'zuul.example.com', 'abcdef123'),
+            osfinger.parse_build(
+                'tempest=https://zuul.example.com/t/x/stream/abcdef123'
+                '?logfile=console.log'))
+        self.assertEqual(
+            ('abcdef1', 'zuul.example.com', 'abcdef123'),
+            osfinger.parse_build(
+                'https://zuul.example.com/t/x/stream/abcdef123?a=b'))
+        self.assertEqual(('abcdef1', osfinger.FINGER_HOST, 'abcdef123'),
+                         osfinger.parse_build('abcdef123'))
+
+    def test_line_prefixer(self):
+        write = mock.Mock()
+        prefixer = osfinger.LinePrefixer('job| ', write)
+        prefixer('ab')
+        prefixer('c\nde\nf')
+        prefixer('g')
+        prefixer.flush()
+        write.assert_has_calls([
+            mock.call('job| abc\njob| de\n'), mock.call('job| fg\n'),
+        ])
+
+    def test_stream_builds(self):
+        connections = {}
+
+        async def handle(reader, writer):
+            build = (await reader.readline()).decode().strip()
+            connections[build] = connections.get(build, 0) + 1
+            if connections[build] == 1:
+                writer.write(('%s one\n%s tw' % (build, build)).encode())
+                await writer.drain()
+                await asyncio.sleep(0.01)
+                # Drop it half way through a line
+                writer.write(b'o\n')
+            elif connections[build] == 2:
+                writer.write(('%s one\n%s two\n%s three\n' % (
+                    build, build, build)).encode())
+            else:
+                writer.write(b'Build not found')
+            await writer.drain()
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            builds = [('job%i' % i, '127.0.0.1', 'build%i' % i)
+                      for i in range(20)]
+            async with server:
+                await osfinger.stream_builds(builds, 5, output.append, port)
+
+        output = []
+        asyncio.run(run())
+        lines = ''.join(output).splitlines()
+        self.assertEqual(60, len(lines))
+        for i in range(20):
+            self.assertEqual(
+                ['job%i| build%i %s' % (i, i, n)
+                 for n in ('one', 'two', 'three')],
+                [line for line in lines if line.startswith('job%i|' % i)])
+        self.assertEqual(3, connections['build0'])
+
+    @mock.patch.object(osfinger, 'RECONNECT_DELAY', 0)
+    @mock.patch.object(osfinger, 'CONNECT_ATTEMPTS', 3)
+    def test_stream_builds_gives_up(self):
+        async def run():
+            # A port nothing is listening on any more
+            server = await asyncio.start_server(lambda r, w: None,
+                                                '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            server.close()
+            await server.wait_closed()
+            with mock.patch.object(asyncio.get_running_loop(),
+                                   'create_connection',
+                                   wraps=asyncio.get_running_loop()
+                                   .create_connection) as connect:
+                await asyncio.wait_for(osfinger.stream_builds(
+                    [('job', '127.0.0.1', 'build')], 1, output.append,
+                    port), 5)
+            self.assertEqual(3, connect.call_count)
+
+        output = []
+        asyncio.run(run())
+        self.assertEqual([], output)
+
+    def test_output_backpressure(self):
+        async def run():
+            read_fd, write_fd = os.pipe()
+            self.addCleanup(os.close, read_fd)
+            os.set_blocking(read_fd, False)
+            pipe = os.fdopen(write_fd, 'wb')
+            self.addCleanup(pipe.close)
+            output = osfinger.OutputStage(flush_size=1024, high_water=4096)
+            await output.connect(pipe)
+            reader = mock.Mock()
+            reader.is_closing.return_value = False
+            output.add_reader(reader)
+            for i in range(200):
+                output.write('x' * 1000)
+            # More than the pipe holds, so we stop reading
+            reader.pause_reading.assert_called_once_with()
+            received = b''
+            while len(received) < 200000:
+                await asyncio.sleep(0.001)
+                try:
+                    received += os.read(read_fd, 65536)
+                except BlockingIOError:
+                    pass
+            reader.resume_reading.assert_called_once_with()
+            await output.close()
+            self.assertEqual(1, output.pauses)
+            self.assertEqual(200000, output.bytes)
+            self.assertLess(output.writes, 200)
+            # Whoever else writes to the pipe finds it as it was
+            self.assertTrue(os.get_blocking(write_fd))
+
+        asyncio.run(run())
+
+    def test_output_shared_with_stderr(self):
+        async def run():
+            read_fd, write_fd = os.pipe()
+            self.addCleanup(os.close, read_fd)
+            pipe = os.fdopen(write_fd, 'wb')
+            self.addCleanup(pipe.close)
+            stderr = os.dup(2)
+            self.addCleanup(os.close, stderr)
+            # Like 2>&1 | less
+            os.dup2(write_fd, 2)
+            try:
+                output = osfinger.OutputStage(flush_size=1)
+                await output.connect(pipe)
+                self.assertTrue(os.get_blocking(write_fd))
+                output.write('hello\n')
+                await output.close()
+            finally:
+                os.dup2(stderr, 2)
+            self.assertEqual(b'hello\n', os.read(read_fd, 100))
+
+        asyncio.run(run())
+
+    def _filter(self, text, chunk=None, **kwargs):
+        output = []
+        line_filter = osfinger.LineFilter(write=output.append, **kwargs)
+        chunk = chunk or len(text)
+        for i in range(0, len(text), chunk):
+            line_filter(text[i:i + chunk])
+        line_filter.flush()
+        return ''.join(output)
+
+    def test_line_filter(self):
+        text = ''.join('%i%s\n' % (i, ' ERROR' if i in (5, 7, 30) else '')
+                       for i in range(40))
+        expected = '4\n5 ERROR\n6\n7 ERROR\n8\n--\n29\n30 ERROR\n31\n'
+        for chunk in (1, 3, 7, 100, None):
+            self.assertEqual(expected, self._filter(
+                text, chunk, include=['ERROR'], context=1))
+        self.assertEqual('5 ERROR\n7 ERROR\n', self._filter(
+            text, 4, include=['ERROR', 'nothing'], exclude=['30']))
+        # Excluded lines are as good as not there
+        self.assertEqual('4\n5 ERROR\n6\n--\n29\n30 ERROR\n32\n',
+                         self._filter(text, 5, include=['ERROR'],
+                                      exclude=['7', '31'], context=1))
+        self.assertEqual('0\n1\n2\n', self._filter('0\n1\n2', 1,
+                                                   exclude=['[3-9]']))
+        # Anchors match at every line, not just the start of a chunk
+        self.assertEqual('ERROR boom\n', self._filter(
+            'info\nERROR boom\n', None, include=['^ERROR']))
+        self.assertEqual('ERROR\n', self._filter(
+            'ERROR\nnot an ERROR here\n', None, include=['^ERROR$']))
+
+    def test_line_filter_highlight(self):
+        text = 'fine\nan ERROR and a WARNING\nTraceback\nWARNING\nend'
+        self.assertEqual(
+            'fine\n\033[31man ERROR and a WARNING\033[0m\n'
+            '\033[1;31mTraceback\033[0m\n\033[33mWARNING\033[0m\nend\n',
+            self._filter(text, 6, highlight=True))
+        self.assertEqual('\033[1;31mTraceback\033[0m\n',
+                         self._filter(text, 6, include=['Trace'],
+                                      highlight=True))
+
+    def _spool_dir(self):
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        return spool_dir
+
+    def _console(self, lines=100):
+        return ''.join('line %i%s \u00e9\n' % (
+            i, ' ERROR' if i % 40 == 7 else '') for i in range(lines)).encode()
+
+    @mock.patch.object(osfinger, 'SPOOL_BLOCK', 100)
+    def test_spool(self):
+        spool_dir = self._spool_dir()
+        data = self._console()
+        spool = osfinger.Spool(spool_dir, 'build')
+        for i in range(0, len(data), 37):
+            spool.write(data[i:i + 37])
+        spool.close(ended=True)
+
+        spool = osfinger.Spool(spool_dir, 'build')
+        self.assertTrue(spool.ended)
+        self.assertEqual(len(data), spool.length)
+        self.assertEqual(100, spool.lines)
+        self.assertGreater(len(spool.blocks), 10)
+        blocks = list(spool.read())
+        self.assertEqual(data, b''.join(blocks))
+        for block in blocks:
+            self.assertTrue(block.endswith(b'\n'))
+        self.assertEqual(data.splitlines(True)[-3:], spool.tail(3))
+        self.assertEqual([], spool.tail(0))
+        self.assertEqual(data.splitlines(True), spool.tail(1000))
+
+        with mock.patch.object(spool, 'read', wraps=spool.read) as read:
+            self.assertEqual([b'line 7 ERROR \xc3\xa9\n',
+                              b'line 47 ERROR \xc3\xa9\n',
+                              b'line 87 ERROR \xc3\xa9\n'],
+                             list(spool.grep('ERROR')))
+            # Only the blocks with ERROR in them were read
+            self.assertEqual(3, len(read.call_args[0][0]))
+        self.assertEqual([b'line 9 \xc3\xa9\n', b'line 99 \xc3\xa9\n'],
+                         list(spool.grep(r'line (9|99) ')))
+
+    @mock.patch.object(osfinger, 'SPOOL_BLOCK', 100)
+    def test_spool_long_line(self):
+        spool_dir = self._spool_dir()
+        data = b'x' * 100 + '\u00e9'.encode() * 100
+        spool = osfinger.Spool(spool_dir, 'text')
+        spool.write(data[:100])
+        spool.write(data[100:])
+        spool.close(ended=True)
+        blocks = list(osfinger.Spool(spool_dir, 'text').read())
+        self.assertEqual(data, b''.join(blocks))
+        for block in blocks:
+            # No character is split between blocks
+            self.assertLessEqual(len(block.decode()), 100)
+        # Nor is anything lost when there are no characters to keep whole
+        spool = osfinger.Spool(spool_dir, 'binary')
+        spool.write(b'\x80' * 300)
+        spool.close(ended=True)
+        self.assertEqual(b'\x80' * 300, b''.join(
+            osfinger.Spool(spool_dir, 'binary').read()))
+
+    @mock.patch.object(osfinger, 'SPOOL_BLOCK', 100)
+    def test_spool_recovers(self):
+        spool_dir = self._spool_dir()
+        data = self._console(20)
+        spool = osfinger.Spool(spool_dir, 'build')
+        spool.write(data + b'\xc3')
+        spool.rewind(len(data))
+        spool.close()
+        # As if we died half way through writing the next block
+        with open(spool.path, 'ab') as f:
+            f.write(b'junk')
+        with open(spool.index_path, 'a') as f:
+            f.write('{"offset": ')
+
+        spool = osfinger.Spool(spool_dir, 'build')
+        self.assertFalse(spool.ended)
+        self.assertEqual(len(data), spool.length)
+        spool.write(b'more\n')
+        spool.close(ended=True)
+        spool = osfinger.Spool(spool_dir, 'build')
+        self.assertEqual(data + b'more\n', b''.join(spool.read()))
+
+    def test_evict_spools(self):
+        spool_dir = self._spool_dir()
+        for i, name in enumerate(('a', 'b', 'c')):
+            spool = osfinger.Spool(spool_dir, name)
+            spool.write(os.urandom(400 * 1024))
+            spool.close()
+            os.utime(spool.path, (i, i))
+        osfinger.evict_spools(spool_dir, 1,
+                              [os.path.join(spool_dir, 'a.spool')])
+        self.assertEqual(['a.index', 'a.spool', 'c.index', 'c.spool'],
+                         sorted(os.listdir(spool_dir)))
+
+    def test_stream_spooled(self):
+        spool_dir = self._spool_dir()
+        data = self._console()
+        connections = []
+
+        async def handle(reader, writer):
+            await reader.readline()
+            connections.append(None)
+            if len(connections) == 1:
+                writer.write(data)
+            else:
+                writer.write(b'Build not found')
+            await writer.drain()
+            writer.close()
+
+        async def run(write):
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                await osfinger.stream_builds(
+                    [('job', '127.0.0.1', 'build')], write=write.append,
+                    port=port, spool_dir=spool_dir)
+
+        # Some of it was streamed before
+        spool = osfinger.Spool(spool_dir, 'build')
+        spool.write(data[:len(data) // 2])
+        spool.close()
+
+        # Shows that from the spool, and only the rest from zuul
+        output = []
+        asyncio.run(run(output))
+        self.assertEqual(data.decode(), ''.join(output))
+        self.assertEqual(2, len(connections))
+        spool = osfinger.Spool(spool_dir, 'build')
+        self.assertTrue(spool.ended)
+        self.assertEqual(data, b''.join(spool.read()))
+
+        # Finished, so no need to ask zuul at all
+        output = []
+        asyncio.run(run(output))
+        self.assertEqual(data.decode(), ''.join(output))
+        self.assertEqual(2, len(connections))
+
+        output = []
+        self.assertTrue(osfinger.show_spools(
+            [('job', None, 'build')], 'ERROR', 2, spool_dir, output.append))
+        self.assertEqual('line 47 ERROR \u00e9\nline 87 ERROR \u00e9\n',
+                         ''.join(output))
+        self.assertFalse(osfinger.show_spools(
+            [('job', None, 'other')], None, 2, spool_dir, output.append))
+
+    def test_no_test_imports(self):
+        result = subprocess.run(
+            [sys.executable, '-c',
+             'import osfinger, sys; print("unittest" in sys.modules)'],
+            cwd=os.path.dirname(os.path.abspath(osfinger.__file__)),
+            capture_output=True, text=True, check=True)
+        self.assertEqual('False', result.stdout.strip())